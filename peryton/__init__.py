@@ -13,34 +13,64 @@ __email__      = 'dmculley@gmail.com'
 __status__     = 'PRE-RELEASE: early development'
 
 
-# Import the modules for the package
-from helpers import *
-from problem import *
-from domain import *
-from boundary_conditions import *
-from initial_conditions import *
-from solvers import *
-from navier_stokes import *
-
-
-# Print welcome message
-import time
-import subprocess
-from mpi4py import MPI
-msg = '\n\nPeryton \nSteady-state RANS solver\n'
-info_out(msg)
-msg = time.strftime("%d/%m/%Y - %H:%M:%S") + ' Peryton version: ' + __version__
-info_out(msg)
-if MPI.COMM_WORLD.Get_rank() == 0:
-    if 'peryton/__init__.pyc' in __file__:
-        get_dir = __file__.replace('peryton/__init__.pyc', '.git')
-    elif 'peryton/__init__.py' in __file__:
-        get_dir = __file__.replace('peryton/__init__.py', '.git')
-    try: label = subprocess.check_output(['git', '--git-dir='+get_dir, 'rev-parse', 'HEAD'])
-    except: label = 'Could not retrieve git hash code'
-    info_out('Installation hash code: ' + label)
-    info_out('Installation location: {}\n'.format(__file__))
-
-
-# Make firedrake (or COFFEE really) a little less chatty
-set_log_level('CRITICAL')
+# The modules for the package are imported lazily: `import peryton` is cheap,
+# and the modules (and with them firedrake) are loaded the first time anything
+# is looked up in the package, or on `from peryton import *`. Their names are
+# exported in this order, as if they had been star imported.
+import sys
+import types
+import importlib
+
+_submodules = ['helpers',
+               'problem',
+               'monitor',
+               'diagnostics',
+               'probes',
+               'domain',
+               'boundary_conditions',
+               'initial_conditions',
+               'transfer',
+               'solvers',
+               'navier_stokes',
+               'ensemble']
+
+
+class _LazyPackage(types.ModuleType):
+    """ The package module, which loads its modules on first use.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name != '__all__':
+            raise AttributeError(name)
+        self._load()
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError("'peryton' has no attribute '{}'"\
+                                 .format(name))
+
+    def _load(self):
+        if self.__dict__['_loaded'] or self.__dict__['_loading']:
+            return
+        self.__dict__['_loading'] = True
+        try:
+            exported = set()
+            for submodule in _submodules:
+                module = importlib.import_module(__name__ + '.' + submodule)
+                names = getattr(module, '__all__', None)
+                if names is None:
+                    names = [n for n in dir(module) if not n.startswith('_')]
+                for n in names:
+                    self.__dict__[n] = getattr(module, n)
+                exported.update(names)
+            self.__dict__['__all__'] = sorted(exported)
+            self.__dict__['_loaded'] = True
+        finally:
+            self.__dict__['_loading'] = False
+
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(globals())
+_package.__dict__['_loaded'] = False
+_package.__dict__['_loading'] = False
+sys.modules[__name__] = _package
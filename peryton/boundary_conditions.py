@@ -5,7 +5,8 @@
 """
 
 from firedrake import *
-from helpers import info_out
+from .helpers import info_out
+from collections import OrderedDict
 
 class NS_BoundaryConditions(object):
     """ This class holds the strong Dirichlet boundary conditions for
@@ -18,6 +19,8 @@ class NS_BoundaryConditions(object):
         self.domain = None
         # Keep a list of the boundary conditions that have been set
         self.list_of_bcs_set = []
+        # The DirichletBC objects, built once per variable and function space
+        self._dirichlet_bcs = {}
 
 
     def _diagnose_input(self, bc_list, expression, facet_id, time_dependent):
@@ -36,6 +39,9 @@ class NS_BoundaryConditions(object):
         else:
             bc_list.append([expression, facet_id, time_dependent])
 
+        # Any DirichletBCs already built are out of date
+        self._dirichlet_bcs = {}
+
 
     def add_bc_u(self, expression, facet_id, time_dependent=False):
         """ List of velocity boundary conditions' parameters
@@ -57,3 +63,86 @@ class NS_BoundaryConditions(object):
         :type facet_id: int
         """
         self._diagnose_input(self.bc_p_list, expression, facet_id, time_dependent)
+
+
+    def process_boundary_conditions(self):
+        """ Turns the bcs into a dictionary for easy application.
+        """
+        self.boundary_conditions = {'u': self.bc_u_list,
+                                    'p': self.bc_p_list}
+
+
+    @property
+    def time_dependent(self):
+        """ Whether any of the conditions are time dependent
+        """
+        return any(time_dependent for expression, facet_id, time_dependent
+                   in self.bc_u_list + self.bc_p_list)
+
+
+    def get_dirichlet_bcs(self, name, function_space, homogeneous=False):
+        """ Returns the :class:`firedrake.DirichletBC` objects for a variable.
+        These are built (with their boundary nodes) the first time they are
+        asked for on a function space and reused afterwards.
+
+        Facets with the same condition share a single DirichletBC. If several
+        conditions have been set on a facet the last one is used.
+
+        :param name: The variable -- 'u' or 'p'
+        :type name: str
+        :param function_space: The space the conditions are applied on
+        :type function_space: :class:`firedrake.FunctionSpace`
+        :param homogeneous: Whether to make the homogeneous conditions instead
+        :type homogeneous: bool
+        """
+        key = (name, function_space, homogeneous)
+        if key not in self._dirichlet_bcs:
+            self._dirichlet_bcs[key] = \
+                self._make_dirichlet_bcs(name, function_space, homogeneous)
+        return [bc for bc, expression, time_dependent
+                in self._dirichlet_bcs[key]]
+
+
+    def _make_dirichlet_bcs(self, name, function_space, homogeneous):
+        """ Builds the (merged) DirichletBCs for a variable
+        """
+        self.process_boundary_conditions()
+
+        # The last condition set on a facet takes precedence
+        conditions = OrderedDict()
+        for expression, facet_id, time_dependent \
+                in self.boundary_conditions[name]:
+            conditions.pop(facet_id, None)
+            conditions[facet_id] = (expression, time_dependent)
+
+        # Group the facets sharing a condition
+        groups = OrderedDict()
+        for facet_id, (expression, time_dependent) in conditions.items():
+            group = groups.setdefault((id(expression), time_dependent),
+                                      [expression, time_dependent, []])
+            group[2].append(facet_id)
+
+        bcs = []
+        for expression, time_dependent, facets in groups.values():
+            bc = DirichletBC(function_space, expression, tuple(facets))
+            if homogeneous:
+                bc.homogenize()
+            # Compute the boundary nodes now rather than on first application
+            bc.nodes
+            bcs.append((bc, expression, time_dependent and not homogeneous))
+        return bcs
+
+
+    def update(self, t):
+        """ Re-evaluates the time dependent conditions at time t. Expressions
+        with a `t` attribute have it set first.
+
+        :param t: The time
+        :type t: float
+        """
+        for bcs in self._dirichlet_bcs.values():
+            for bc, expression, time_dependent in bcs:
+                if time_dependent:
+                    if hasattr(expression, 't'):
+                        expression.t = t
+                    bc.function_arg = expression
@@ -0,0 +1,128 @@
+"""
+.. module:: diagnostics
+   :synopsis: Integrated quantities on the labelled facets of the domain,
+    recorded every iteration
+
+"""
+
+from firedrake import *
+from .helpers import *
+from .monitor import CSVHistory
+
+
+class FacetDiagnostics(object):
+    """ Computes the mass flux through the inlets and outlets, the mean
+    pressure drop from the inlets to the outlets and the force on the walls,
+    using the boundary lists of the domain.
+
+    All the facet integrals are the components of a single form on a 'real'
+    vector space, so they are assembled in one pass with one reduction. Only
+    the few numbers are kept, and written in chunks to a .csv file (see
+    :class:`CSVHistory`) -- the runs can be followed without writing fields.
+
+    :param domain: The domain, with its inlet, outlet and wall lists set
+    :type domain: :class:`PrototypeDomain`
+    :param velocity: The velocity
+    :type velocity: :class:`firedrake.Function`
+    :param pressure: The (kinematic) pressure
+    :type pressure: :class:`firedrake.Function`
+    :param viscosity: The kinematic viscosity
+    :type viscosity: :class:`firedrake.Constant`
+    :param density: The density, which the forces are scaled by
+    :type density: :class:`firedrake.Constant`
+    :param filename: The .csv file (None keeps nothing)
+    :type filename: str
+    """
+
+    def __init__(self, domain, velocity, pressure, viscosity, density,
+                 filename=None, chunk_size=100):
+
+        self.mesh = domain.mesh
+        n_dims = domain.n_dims
+        u = velocity
+        p = pressure
+        n = FacetNormal(self.mesh)
+
+        def measure(facets):
+            return ds(tuple(facets)) if facets else None
+
+        # The integrands and where they are integrated
+        stress = -p*Identity(n_dims) + viscosity*(grad(u) + grad(u).T)
+        force = density*dot(stress, n)
+        integrals = [('inlet_mass_flux', density*dot(u, n),
+                      measure(domain.inlet_list)),
+                     ('outlet_mass_flux', density*dot(u, n),
+                      measure(domain.outlet_list)),
+                     ('inlet_pressure', p, measure(domain.inlet_list)),
+                     ('outlet_pressure', p, measure(domain.outlet_list))]
+        for i, component in enumerate('xyz'[:n_dims]):
+            integrals.append(('wall_force_' + component, force[i],
+                              measure(domain.wall_list)))
+        self.names = [name for name, integrand, dS in integrals]
+
+        R = VectorFunctionSpace(self.mesh, 'R', 0, dim=len(integrals))
+        r = TestFunction(R)
+        terms = [integrand*r[i]*dS
+                 for i, (name, integrand, dS) in enumerate(integrals)
+                 if dS is not None]
+        self.form = sum(terms[1:], terms[0]) if terms else None
+        self.values = None
+
+        # The areas the pressures are averaged over
+        self.inlet_area = self._area(domain.inlet_list)
+        self.outlet_area = self._area(domain.outlet_list)
+
+        self.columns = ['iteration', 't', 'inlet_mass_flux',
+                        'outlet_mass_flux', 'mass_imbalance',
+                        'inlet_mean_pressure', 'outlet_mean_pressure',
+                        'pressure_drop'] \
+                       + self.names[4:]
+        self.history = CSVHistory(self.mesh.comm, filename, self.columns,
+                                  chunk_size)
+
+
+    def _area(self, facets):
+        if not facets:
+            return 0.
+        return assemble(Constant(1)*ds(tuple(facets), domain=self.mesh))
+
+
+    def reset(self, new_file=True):
+        """ Starts a new history, appending to the file if `new_file` is
+        False
+        """
+        self.history.reset(new_file)
+
+
+    @profile
+    def update(self, it_no, t):
+        """ Computes and records the diagnostics at the current state, and
+        returns them as a dictionary.
+        """
+        if self.form is not None:
+            self.values = assemble(self.form, tensor=self.values)
+            values = dict(zip(self.names, self.values.dat.data_ro[0]))
+        else:
+            values = dict.fromkeys(self.names, 0.)
+
+        def mean(integral, area):
+            return integral/area if area else 0.
+
+        values['mass_imbalance'] = values['inlet_mass_flux'] \
+                                   + values['outlet_mass_flux']
+        values['inlet_mean_pressure'] = mean(values['inlet_pressure'],
+                                             self.inlet_area)
+        values['outlet_mean_pressure'] = mean(values['outlet_pressure'],
+                                              self.outlet_area)
+        values['pressure_drop'] = values['inlet_mean_pressure'] \
+                                  - values['outlet_mean_pressure']
+        values['iteration'] = it_no
+        values['t'] = t
+        self.history.append([values[column] for column in self.columns])
+        return values
+
+
+    def flush(self):
+        """ Appends the recorded rows to the file
+        """
+        self.history.flush()
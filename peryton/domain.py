@@ -4,13 +4,24 @@
 
 """
 
+import os
 import os.path
+import json
+import hashlib
 from firedrake import *
+from .helpers import checkpoint_has_attr
 
 class PrototypeDomain(object):
     """ An prototypical domain class.
     """
 
+    # The mesh hierarchy the mesh is the finest level of, if there is one
+    hierarchy = None
+    # The distance to the nearest wall, once it has been computed or loaded,
+    # and the wall facets it was computed for
+    _wall_distance = None
+    _wall_distance_walls = None
+
     def __init__(self):
         raise NotImplementedError("Domain is a base class only.")
 
@@ -49,27 +60,142 @@ class PrototypeDomain(object):
         if not isinstance(facet, list): facet = [facet]
         for f in facet:
             self.facet_labels[str(f)] = label
-            if inlet:
+            if inlet and f not in self.inlet_list:
                 self.inlet_list.append(f)
-            if outlet:
+            if outlet and f not in self.outlet_list:
                 self.outlet_list.append(f)
-            if wall:
+            if wall and f not in self.wall_list:
                 self.wall_list.append(f)
-            if free_slip_boundary:
+            if free_slip_boundary and f not in self.free_slip_boundary_list:
                 self.free_slip_boundary_list.append(f)
 
+    # The facet metadata stored alongside the mesh in HDF5 files
+    _metadata = ['facet_labels', 'inlet_list', 'outlet_list', 'wall_list',
+                 'free_slip_boundary_list']
+
+    def save_metadata(self, checkpoint):
+        """ Store the facet labels and boundary lists in a checkpoint file
+
+        :param checkpoint: An open checkpoint file
+        :type checkpoint: :class:`firedrake.CheckpointFile`
+        """
+        checkpoint.require_group('/peryton/domain')
+        for name in self._metadata:
+            checkpoint.set_attr('/peryton/domain', name,
+                                json.dumps(getattr(self, name)))
+
+    def load_metadata(self, checkpoint):
+        """ Read the facet labels and boundary lists from a checkpoint file.
+        Those missing from the file (e.g. one written by an older version)
+        keep their current values.
+
+        :param checkpoint: An open checkpoint file
+        :type checkpoint: :class:`firedrake.CheckpointFile`
+        """
+        for name in self._metadata:
+            if checkpoint_has_attr(checkpoint, '/peryton/domain', name):
+                setattr(self, name, json.loads(
+                    checkpoint.get_attr('/peryton/domain', name)))
+
+    def wall_distance(self):
+        """ The distance to the nearest wall facet (see
+        :func:`compute_wall_distance`), as a P1 field. It is computed once per
+        domain, or loaded if it has been stored with the mesh. It is computed
+        again if the wall list has changed since.
+        """
+        walls = sorted(self.wall_list)
+        if self._wall_distance_walls != walls:
+            self._wall_distance = None
+        if self._wall_distance is None:
+            self._wall_distance = self._read_wall_distance()
+            self._wall_distance_walls = walls
+        if self._wall_distance is None:
+            self._wall_distance = compute_wall_distance(self.mesh,
+                                                        self.wall_list)
+            self._write_wall_distance()
+        return self._wall_distance
+
+    @staticmethod
+    def _wall_distance_name(walls):
+        """ The name the wall distance for a list of walls is stored under
+        """
+        return 'wall_distance_' + '_'.join(str(wall) for wall in walls)
+
+    @staticmethod
+    def _stored_wall_lists(checkpoint):
+        """ The wall lists a checkpoint file holds wall distances for
+        """
+        if not checkpoint_has_attr(checkpoint, '/peryton/domain',
+                                   'wall_distances'):
+            return []
+        return json.loads(checkpoint.get_attr('/peryton/domain',
+                                              'wall_distances'))
+
+    def save_wall_distance(self, checkpoint):
+        """ Store the wall distance, if it has been computed, in a checkpoint
+        file. It is stored under a name made from the wall list, so a file
+        can hold the distances for several wall lists.
+
+        :param checkpoint: An open checkpoint file
+        :type checkpoint: :class:`firedrake.CheckpointFile`
+        """
+        if self._wall_distance is None:
+            return
+        walls = self._wall_distance_walls
+        stored = self._stored_wall_lists(checkpoint)
+        if walls in stored:
+            return
+        checkpoint.require_group('/peryton/domain')
+        checkpoint.save_function(self._wall_distance,
+                                 name=self._wall_distance_name(walls))
+        checkpoint.set_attr('/peryton/domain', 'wall_distances',
+                            json.dumps(stored + [walls]))
+
+    def load_wall_distance(self, checkpoint):
+        """ Read the wall distance for the current wall list from a checkpoint
+        file, returning None if it is not there
+
+        :param checkpoint: An open checkpoint file
+        :type checkpoint: :class:`firedrake.CheckpointFile`
+        """
+        walls = sorted(self.wall_list)
+        if walls not in self._stored_wall_lists(checkpoint):
+            return None
+        return checkpoint.load_function(self.mesh,
+                                        self._wall_distance_name(walls))
+
+    def _read_wall_distance(self):
+        """ The stored wall distance, if the domain has somewhere to store it
+        """
+        return None
+
+    def _write_wall_distance(self):
+        """ Store the wall distance, if the domain has somewhere to store it
+        """
+        pass
+
 
 class FileDomain(PrototypeDomain):
     """ Create a domain from a mesh file (.msh).
 
+    Reading a .msh file is serial and the mesh then has to be partitioned and
+    distributed. If a `cache_dir` is given, the distributed mesh is stored
+    there (in HDF5) the first time, keyed on the content of the mesh file and
+    the number of processes, and later runs load it directly in parallel. The
+    facet labels and boundary lists are cached with it once
+    :meth:`save_to_cache` has been called, and are restored on later runs. So
+    is the wall distance, once it has been computed (along with the wall list
+    it was computed for, so it is computed again if the walls change).
+
     :param mesh_file: The .msh file of the mesh.
     :type mesh_file: str
+    :param cache_dir: Directory for the cached mesh (None disables caching)
+    :type cache_dir: str
 
     """
 
-    def __init__(self, mesh_file):
+    def __init__(self, mesh_file, cache_dir=None, comm=COMM_WORLD):
 
-        self.mesh = Mesh(mesh_file)
         # Stores string facet labels against their id number
         self.facet_labels = {}
         # Create a list of boundary types
@@ -77,20 +203,97 @@ class FileDomain(PrototypeDomain):
         self.outlet_list = []
         self.wall_list = []
         self.free_slip_boundary_list = []
+
+        self.cache_file = None
+        if cache_dir is None:
+            self.mesh = Mesh(mesh_file, comm=comm)
+        else:
+            self.cache_file = self._cache_file_name(mesh_file, cache_dir, comm)
+            if comm.bcast(os.path.exists(self.cache_file)
+                          if comm.rank == 0 else None, root=0):
+                with CheckpointFile(self.cache_file, 'r', comm=comm) as f:
+                    self.mesh = f.load_mesh()
+                    self.load_metadata(f)
+            else:
+                self.mesh = Mesh(mesh_file, comm=comm)
+                self._write_cache(comm)
         self.n_dims = self.mesh.geometric_dimension()
 
+    @staticmethod
+    def _cache_file_name(mesh_file, cache_dir, comm):
+        """ The cache file for the mesh file on this number of processes
+        """
+        digest = None
+        if comm.rank == 0:
+            sha = hashlib.sha1()
+            with open(mesh_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+        digest = comm.bcast(digest, root=0)
+        stem = os.path.splitext(os.path.basename(mesh_file))[0]
+        return os.path.join(cache_dir, '{}_{}_np{}.h5'\
+                            .format(stem, digest[:16], comm.size))
+
+    def _write_cache(self, comm):
+        """ Write the distributed mesh and the metadata to the cache file
+        """
+        temp_file = self.cache_file + '.tmp'
+        with CheckpointFile(temp_file, 'w', comm=comm) as f:
+            f.save_mesh(self.mesh)
+            self.save_metadata(f)
+        if comm.rank == 0:
+            os.rename(temp_file, self.cache_file)
+        comm.barrier()
+
+    def save_to_cache(self):
+        """ Store the current facet labels and boundary lists in the cache
+        file, so later runs do not need to label the facets again
+        """
+        if self.cache_file is None:
+            raise ValueError("FileDomain was created without a cache_dir")
+        with CheckpointFile(self.cache_file, 'a', comm=self.mesh.comm) as f:
+            self.save_metadata(f)
+
+    def _read_wall_distance(self):
+        if self.cache_file is None:
+            return None
+        with CheckpointFile(self.cache_file, 'r', comm=self.mesh.comm) as f:
+            return self.load_wall_distance(f)
+
+    def _write_wall_distance(self):
+        if self.cache_file is None:
+            return
+        with CheckpointFile(self.cache_file, 'a', comm=self.mesh.comm) as f:
+            self.save_wall_distance(f)
+
 
 class SimpleDomain(PrototypeDomain):
     """ Create a domain from a firedrake Mesh object.
 
+    With `refinement_levels` > 0 a :class:`firedrake.MeshHierarchy` is built
+    by uniformly refining the mesh, and the domain's mesh is the finest level.
+    The facet markers are kept on every level, so the facet labels and
+    boundary lists hold for all of them. The hierarchy is used for geometric
+    multigrid and nested iteration.
+
     :param mesh: The mesh object.
     :type mesh_file: firedrake.Mesh
+    :param refinement_levels: Number of times to refine the mesh
+    :type refinement_levels: int
 
     """
 
-    def __init__(self, mesh):
+    def __init__(self, mesh, refinement_levels=0):
 
-        self.mesh = mesh
+        self.base_mesh = mesh
+        if refinement_levels > 0:
+            self.hierarchy = MeshHierarchy(mesh, refinement_levels)
+            self.mesh = self.hierarchy[-1]
+        else:
+            self.mesh = mesh
         # Stores string facet labels against their id number
         self.facet_labels = {}
         # Create lists of boundary types
@@ -100,4 +303,75 @@ class SimpleDomain(PrototypeDomain):
         self.free_slip_boundary_list = []
         self.n_dims = self.mesh.geometric_dimension()
 
+    def level(self, i):
+        """ A domain for level i of the mesh hierarchy, sharing this domain's
+        facet labels and boundary lists
+
+        :param i: The level (0 is the coarsest)
+        :type i: int
+        """
+        if self.hierarchy is None:
+            raise ValueError("Domain has no mesh hierarchy")
+        domain = SimpleDomain(self.hierarchy[i])
+        for name in self._metadata:
+            setattr(domain, name, getattr(self, name))
+        return domain
+
+
+class CheckpointDomain(PrototypeDomain):
+    """ Create a domain from a Peryton checkpoint file (.h5), including the
+    facet labels and boundary lists. The file can be read on a different
+    number of processes to the one which wrote it.
+
+    :param checkpoint_file: The .h5 checkpoint file.
+    :type checkpoint_file: str
+
+    """
+
+    def __init__(self, checkpoint_file, comm=COMM_WORLD):
+
+        self.checkpoint_file = checkpoint_file
+        # Stores string facet labels against their id number
+        self.facet_labels = {}
+        # Create a list of boundary types
+        self.inlet_list = []
+        self.outlet_list = []
+        self.wall_list = []
+        self.free_slip_boundary_list = []
+        with CheckpointFile(checkpoint_file, 'r', comm=comm) as f:
+            self.mesh = f.load_mesh()
+            self.load_metadata(f)
+        self.n_dims = self.mesh.geometric_dimension()
+
+    def _read_wall_distance(self):
+        with CheckpointFile(self.checkpoint_file, 'r',
+                            comm=self.mesh.comm) as f:
+            return self.load_wall_distance(f)
 
+
+def compute_wall_distance(mesh, wall_facets):
+    """ Computes the distance to the nearest of the wall facets by the Poisson
+    method (Tucker): with -div(grad(phi)) = 1 and phi = 0 on the walls, the
+    distance is sqrt(|grad(phi)|^2 + 2 phi) - |grad(phi)|. This is exact for a
+    single plane wall and a close approximation near the walls, where the
+    turbulence models need it.
+
+    :param mesh: The mesh
+    :type mesh: :class:`firedrake.Mesh`
+    :param wall_facets: The ids of the wall facets
+    :type wall_facets: list of int
+    """
+    if not wall_facets:
+        raise ValueError("The wall distance needs at least one wall facet")
+    V = FunctionSpace(mesh, 'CG', 1)
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    phi = Function(V)
+    solve(inner(grad(u), grad(v))*dx == Constant(1)*v*dx, phi,
+          bcs=DirichletBC(V, Constant(0), tuple(wall_facets)),
+          solver_parameters={'ksp_type': 'cg',
+                             'pc_type': 'gamg'})
+    grad_phi = sqrt(inner(grad(phi), grad(phi)))
+    distance = Function(V, name='wall_distance')
+    distance.project(max_value(sqrt(grad_phi**2 + 2*phi) - grad_phi, 0))
+    return distance
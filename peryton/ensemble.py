@@ -0,0 +1,146 @@
+"""
+.. module:: ensemble
+   :synopsis: Runs parameter sweeps over variations of a problem concurrently
+
+"""
+
+import copy
+import csv
+import os
+import time
+from firedrake import *
+from .helpers import *
+from .problem import Problem
+from .navier_stokes import NS_Algorithm
+
+
+class ParameterSweep(object):
+    """ Runs variations of a problem concurrently on groups of processes.
+
+    The communicator is split into `n_groups` sub-communicators and the cases
+    are dealt out to the groups in turn. Each group builds the domain once and
+    runs its cases one after another on the same mesh, function spaces and
+    compiled forms (see :meth:`NS_Backend.set_problem`). Each case writes its
+    output to its own sub-directory of the algorithm's output directory.
+
+    :param make_domain: Builds the domain on a given communicator -- e.g.
+        `lambda comm: SimpleDomain(RectangleMesh(..., comm=comm))` with the
+        facets labelled
+    :type make_domain: callable
+    :param problem_parameters: The parameters the variations are made to (its
+        domain is ignored)
+    :type problem_parameters: :class:`ProblemParameters`
+    :param variations: The changes to the problem parameters for each case,
+        e.g. `[{'nu': 1e-3}, {'nu': 1e-4}]`. An optional 'name' entry labels
+        the case in the results.
+    :type variations: list of dict
+    :param algorithm_parameters: The algorithm parameters used for every case
+    :type algorithm_parameters: :class:`NS_AlgorithmParameters`
+    :param n_groups: The number of groups of processes (defaults to one group
+        per process, or per case if there are fewer cases)
+    :type n_groups: int
+    """
+
+    def __init__(self, make_domain, problem_parameters, variations,
+                 algorithm_parameters=None, n_groups=None, comm=COMM_WORLD):
+
+        self.make_domain = make_domain
+        self.problem_parameters = problem_parameters
+        self.variations = variations
+        if algorithm_parameters is None:
+            algorithm_parameters = NS_Algorithm.default_parameters()
+        self.algorithm_parameters = algorithm_parameters
+        self.comm = comm
+
+        if n_groups is None:
+            n_groups = min(len(variations), comm.size)
+        if not 1 <= n_groups <= comm.size:
+            raise ValueError("Number of groups must be between 1 and the "
+                             "number of processes ({})".format(comm.size))
+        self.n_groups = n_groups
+
+        # Contiguous blocks of ranks form each group
+        self.group = comm.rank*n_groups//comm.size
+        self.group_comm = comm.Split(color=self.group, key=comm.rank)
+
+
+    def cases(self):
+        """ The (index, variation) pairs run by this process' group.
+        """
+        return [(i, variation) for i, variation in enumerate(self.variations)
+                if i % self.n_groups == self.group]
+
+
+    def run(self):
+        """ Runs all the cases and returns the results table (on every
+        process) as a list of dictionaries, one per case in the order of the
+        variations.
+        """
+        domain = self.make_domain(self.group_comm)
+        # Fill in the defaults once so the cases share e.g. the body forces
+        base_parameters = copy.copy(self.problem_parameters)
+        base_parameters.domain = domain
+        Problem(base_parameters)
+
+        algorithm = None
+        algorithm_parameters = copy.copy(self.algorithm_parameters)
+        output_dir = algorithm_parameters.output_dir
+
+        rows = []
+        for index, variation in self.cases():
+            name = variation.get('name', 'case_{}'.format(index))
+            problem_parameters = copy.copy(base_parameters)
+            for key, value in variation.items():
+                if key != 'name':
+                    setattr(problem_parameters, key, value)
+            problem = Problem(problem_parameters)
+            algorithm_parameters.output_dir = os.path.join(output_dir, name)
+
+            self.group_comm.barrier()
+            start = time.time()
+            if algorithm is None:
+                algorithm = NS_Algorithm(algorithm_parameters, problem)
+            else:
+                algorithm.set_problem(problem)
+            algorithm.run()
+            self.group_comm.barrier()
+            wall_time = time.time() - start
+
+            row = {'case': index, 'name': name, 'group': self.group,
+                   'converged': algorithm.converged,
+                   'iterations': algorithm.it_no,
+                   'residual': algorithm.residual,
+                   'wall_time': wall_time}
+            for key, value in variation.items():
+                if key != 'name':
+                    row[key] = value if isinstance(value, (int, float)) \
+                               else str(value)
+            rows.append(row)
+
+        # Gather the rows from the first process of each group
+        if self.group_comm.rank != 0:
+            rows = []
+        gathered = self.comm.allgather(rows)
+        self.results = sorted([row for group_rows in gathered
+                               for row in group_rows],
+                              key=lambda row: row['case'])
+        return self.results
+
+
+    def write_results(self, filename):
+        """ Writes the results table to a .csv file.
+
+        :param filename: The .csv file
+        :type filename: str
+        """
+        if self.comm.rank != 0:
+            return
+        columns = ['case', 'name', 'group', 'converged', 'iterations',
+                   'residual', 'wall_time']
+        for row in self.results:
+            columns += sorted(k for k in row.keys() if k not in columns)
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in self.results:
+                writer.writerow(row)
@@ -5,17 +5,284 @@
 """
 
 from firedrake import *
-from helpers import *
+from .helpers import *
+from .transfer import SolutionTransfer
+from .probes import ProbeSet
 import os
 import sys
 import time
+import json
+import base64
+import threading
+import queue
+import numpy as np
 
 class GenericBackendParameters(FrozenClass):
 
+    # Human readable names of the variables, used when writing output
+    variable_dictionary = {}
+
     output_dir = os.getcwd() + '/' + 'out_' + sys.argv[0][:-3] + '_on{0}_at{1}'\
                  .format(time.strftime("%d%m"), time.strftime("%H%M"))
     output_file = 'output.pvd'
     output_frequency = 0
+    # Fields are written by a background worker while the solve continues. At
+    # most `output_queue_size` snapshots wait to be written; a further dump
+    # blocks until one has been. A size of 0 writes synchronously.
+    output_queue_size = 2
+
+    # Write a profile of the run (stage timings per iteration, linear solver
+    # iterations, peak memory and load imbalance) to profile.json and
+    # profile.csv in the output directory at the end of the run
+    profile_report = False
+
+    # Checkpoints (parallel HDF5) of the diagnostic fields and the iteration
+    # state are written to `checkpoint_file` in the output directory every
+    # `checkpoint_frequency` iterations and at the end of the run (0 disables
+    # checkpointing).
+    checkpoint_file = 'checkpoint.h5'
+    checkpoint_frequency = 0
+
+    # Start from a checkpoint rather than the initial conditions. The domain
+    # must be built from the same file with :class:`CheckpointDomain`, which
+    # also allows a different number of processes. If
+    # `restart_iteration_state` is False only the fields are loaded, which
+    # warm starts a new case from another case's solution.
+    restart_file = None
+    restart_iteration_state = True
+
+
+# The VTK cell types, and the order the vertices of a firedrake cell are
+# written in
+vtk_cells = {'interval': (3, [0, 1]),
+             'triangle': (5, [0, 1, 2]),
+             'quadrilateral': (9, [0, 1, 3, 2]),
+             'tetrahedron': (10, [0, 1, 2, 3]),
+             'hexahedron': (12, [0, 1, 3, 2, 4, 5, 7, 6])}
+
+vtk_types = {np.dtype(np.float64): 'Float64',
+             np.dtype(np.int64): 'Int64',
+             np.dtype(np.uint8): 'UInt8'}
+
+vtk_header = '<?xml version="1.0"?>\n' \
+             '<VTKFile type="{}" version="1.0" byte_order="{}" ' \
+             'header_type="UInt64">\n'.format('{}', 'LittleEndian'
+                                               if sys.byteorder == 'little'
+                                               else 'BigEndian')
+
+
+def vtk_data_array(name, array, n_components=1):
+    """ Returns an (inline, base64 encoded) VTK data array
+    """
+    data = np.ascontiguousarray(array).tobytes()
+    header = np.array([len(data)], dtype=np.uint64).tobytes()
+    return '<DataArray type="{}" Name="{}" NumberOfComponents="{}" ' \
+           'format="binary">{}{}</DataArray>\n'\
+           .format(vtk_types[array.dtype], name, n_components,
+                   base64.b64encode(header).decode(),
+                   base64.b64encode(data).decode())
+
+
+class AsyncFieldWriter(object):
+    """ Writes snapshots of a list of fields to a .pvd file from a background
+    thread, with a .vtu file per process and a .pvtu file per snapshot in a
+    directory named after the .pvd file.
+
+    Firedrake, PETSc and (without thread support) MPI must only be used from
+    one thread, so everything that touches them happens on the calling
+    thread: the fields are interpolated onto the (degree one) output spaces
+    and copied, cell by cell, to plain arrays, and the worker only encodes the
+    arrays and writes the files. Each cell is written with its own copy of
+    its vertices, so continuous and discontinuous fields share one grid.
+
+    An error in the worker stops the writing, and is raised on the calling
+    thread by the next :meth:`write` or :meth:`close`. The worker keeps taking
+    snapshots off the queue, so the calling thread is never left waiting on
+    it.
+
+    :param filename: The .pvd file to write to
+    :type filename: str
+    :param functions: The fields to be written
+    :type functions: list of :class:`firedrake.Function`
+    :param names: The names the fields are written with
+    :type names: list of str
+    :param queue_size: The number of snapshots which can wait to be written
+    :type queue_size: int
+    """
+
+    def __init__(self, filename, functions, names, queue_size):
+
+        self.functions = functions
+        self.names = names
+        mesh = functions[0].function_space().mesh()
+        comm = mesh.comm
+        self.rank = comm.rank
+        self.n_ranks = comm.size
+        self.filename = filename
+        self.basename = os.path.splitext(os.path.basename(filename))[0]
+        self.directory = os.path.join(os.path.dirname(filename),
+                                      self.basename)
+        if comm.rank == 0 and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        comm.barrier()
+
+        # The output functions, and their nodes cell by cell
+        self.buffers = [Function(self._output_space(f)) for f in functions]
+        self.cell_nodes = [buffer.function_space().cell_node_map().values
+                           for buffer in self.buffers]
+
+        # The grid is the same for every snapshot, so it is encoded once
+        cell_name = mesh.ufl_cell().cellname()
+        if cell_name not in vtk_cells:
+            raise ValueError("Cannot write fields on {} cells"\
+                             .format(cell_name))
+        cell_type, vertex_order = vtk_cells[cell_name]
+        X = VectorFunctionSpace(mesh, 'DG', 1)
+        coordinates = Function(X).interpolate(SpatialCoordinate(mesh))
+        nodes = X.cell_node_map().values
+        n_cells, n_vertices = nodes.shape
+        n_dims = mesh.geometric_dimension()
+        points = np.zeros((nodes.size, 3))
+        points[:, :n_dims] = coordinates.dat.data_ro_with_halos[nodes]\
+                                        .reshape(nodes.size, n_dims)
+        connectivity = np.arange(n_cells, dtype=np.int64)[:, None]\
+                       *n_vertices + np.array(vertex_order, dtype=np.int64)
+        offsets = n_vertices*np.arange(1, n_cells + 1, dtype=np.int64)
+        types = np.full(n_cells, cell_type, dtype=np.uint8)
+        self.grid = '<Piece NumberOfPoints="{}" NumberOfCells="{}">\n'\
+                    .format(nodes.size, n_cells) \
+                    + '<Points>\n' + vtk_data_array('Points', points, 3) \
+                    + '</Points>\n<Cells>\n' \
+                    + vtk_data_array('connectivity', connectivity.ravel()) \
+                    + vtk_data_array('offsets', offsets) \
+                    + vtk_data_array('types', types) + '</Cells>\n'
+
+        self.index = 0
+        self.times = []
+        self.synchronous = queue_size == 0
+        self.worker_error = None
+        if not self.synchronous:
+            self.pending = queue.Queue(maxsize=queue_size)
+            self.worker = threading.Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+
+
+    @staticmethod
+    def _output_space(function):
+        """ The degree one space (of the same family) that the function is
+        written on.
+        """
+        family, degree = get_function_space(function)
+        mesh = function.function_space().mesh()
+        shape = function.ufl_shape
+        if len(shape) == 0:
+            return FunctionSpace(mesh, family, 1)
+        return VectorFunctionSpace(mesh, family, 1, dim=shape[0])
+
+
+    def write(self, t):
+        """ Snapshots the fields and queues them for writing.
+        """
+        self._check_worker()
+        arrays = []
+        for buffer, nodes, function in zip(self.buffers, self.cell_nodes,
+                                           self.functions):
+            buffer.interpolate(function)
+            # Indexing copies, so the worker owns the arrays
+            arrays.append(buffer.dat.data_ro_with_halos[nodes]\
+                          .reshape((nodes.size,) + buffer.ufl_shape))
+        self.times.append(t)
+        item = (self.index, list(self.times), arrays)
+        self.index += 1
+        if self.synchronous:
+            self._write(*item)
+        else:
+            self.pending.put(item)
+
+
+    def _piece_name(self, index, rank):
+        return '{}_{}_{}.vtu'.format(self.basename, index, rank)
+
+
+    def _write(self, index, times, arrays):
+        """ Writes the files of a snapshot (only numpy and file operations)
+        """
+        point_data = ''
+        for name, array in zip(self.names, arrays):
+            if array.ndim == 1:
+                point_data += vtk_data_array(name, array)
+            else:
+                vector = np.zeros((len(array), 3))
+                vector[:, :array.shape[1]] = array
+                point_data += vtk_data_array(name, vector, 3)
+        with open(os.path.join(self.directory,
+                               self._piece_name(index, self.rank)), 'w') as f:
+            f.write(vtk_header.format('UnstructuredGrid')
+                    + '<UnstructuredGrid>\n' + self.grid
+                    + '<PointData>\n' + point_data + '</PointData>\n'
+                    + '</Piece>\n</UnstructuredGrid>\n</VTKFile>\n')
+        if self.rank != 0:
+            return
+
+        # The parallel file collects the pieces of every process
+        parallel_name = '{}_{}.pvtu'.format(self.basename, index)
+        fields = ''.join('<PDataArray type="Float64" Name="{}" '
+                         'NumberOfComponents="{}"/>\n'\
+                         .format(name, 1 if array.ndim == 1 else 3)
+                         for name, array in zip(self.names, arrays))
+        pieces = ''.join('<Piece Source="{}"/>\n'\
+                         .format(self._piece_name(index, rank))
+                         for rank in range(self.n_ranks))
+        with open(os.path.join(self.directory, parallel_name), 'w') as f:
+            f.write(vtk_header.format('PUnstructuredGrid')
+                    + '<PUnstructuredGrid GhostLevel="0">\n'
+                    + '<PPoints>\n<PDataArray type="Float64" '
+                      'NumberOfComponents="3"/>\n</PPoints>\n'
+                    + '<PPointData>\n' + fields + '</PPointData>\n'
+                    + pieces + '</PUnstructuredGrid>\n</VTKFile>\n')
+
+        # The collection lists every snapshot so far
+        datasets = ''.join('<DataSet timestep="{!r}" part="0" '
+                           'file="{}/{}_{}.pvtu"/>\n'\
+                           .format(float(time), self.basename, self.basename,
+                                   i)
+                           for i, time in enumerate(times))
+        with open(self.filename, 'w') as f:
+            f.write(vtk_header.format('Collection') + '<Collection>\n'
+                    + datasets + '</Collection>\n</VTKFile>\n')
+
+
+    def _work(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is None:
+                    return
+                # Once a write has failed the rest are dropped
+                if self.worker_error is None:
+                    self._write(*item)
+            except Exception as e:
+                self.worker_error = e
+            finally:
+                self.pending.task_done()
+
+
+    def _check_worker(self):
+        """ Raises an error the worker hit writing a snapshot.
+        """
+        if self.worker_error is not None:
+            raise RuntimeError("Writing {} failed"\
+                               .format(self.filename)) from self.worker_error
+
+
+    def close(self):
+        """ Waits for all queued snapshots to be written.
+        """
+        if not self.synchronous:
+            self.pending.put(None)
+            self.worker.join()
+        self._check_worker()
 
 
 class GenericBackend(object):
@@ -33,40 +300,207 @@ class GenericBackend(object):
         self.Dt = Constant(self.dt)
         self.t = 0
         self.it_no = 0
+        self.residual_0 = None
 
-        self.params.output_file = File(self.params.output_dir \
-                                       + self.params.output_file)
+        self.output_writer = None
+        self.probes = []
+        self.probe_files = []
 
 
-    def apply_initial_conditions(self):
-        """ Applys the initital conditions to the diagnositc fields.
+    def apply_initial_conditions(self, initial_guess=True):
+        """ Applys the initital conditions to the diagnositc fields, then
+        transfers the fields with initial conditions from a checkpoint on
+        another mesh if one has been given.
+
+        :param initial_guess: Improve on the initial condition expressions
+            (here by the transfer from a checkpoint). Otherwise only the
+            expressions are applied -- e.g. for a reference residual.
+        :type initial_guess: bool
         """
         self.ics.process_initial_conditions()
-        for function in self.params.parameter_dictionary.keys():
-            if function in self.ics.keys():
-                function.interpolate(self.ics.initial_conditions[function])
+        for name, functions in self.diagnostic_variables.items():
+            if name in self.ics.initial_conditions:
+                for function in functions:
+                    function.interpolate(self.ics.initial_conditions[name])
+
+        checkpoint_file = getattr(self.ics, 'checkpoint_file', None)
+        if checkpoint_file is not None and initial_guess:
+            transfer = SolutionTransfer(checkpoint_file,
+                                        self.ics.transfer_tolerance,
+                                        comm=self.mesh.comm)
+            for name, functions in self.diagnostic_variables.items():
+                if name not in self.ics.initial_conditions:
+                    continue
+                transfer.transfer(functions[0])
+                for function in functions[1:]:
+                    function.assign(functions[0])
+            info_out('Transferred the initial conditions from {}'\
+                     .format(checkpoint_file))
 
 
+    @profile
     def apply_boundary_conditions(self):
-        """ Applys the boundary conditions.
+        """ Applys the boundary conditions to the diagnostic fields.
+        """
+        self.bcs.process_boundary_conditions()
+        for name, functions in self.diagnostic_variables.items():
+            if name in self.bcs.boundary_conditions:
+                for function in functions:
+                    V = function.function_space()
+                    for bc in self.bcs.get_dirichlet_bcs(name, V):
+                        bc.apply(function)
+
+
+    def update_timestep(self, dt):
+        """ Sets the size of the next pseudo-timestep.
+        """
+        self.dt = dt
+        self.Dt.assign(dt)
+
+
+    @profile
+    def write_checkpoint(self):
+        """ Writes the current diagnostic fields, the domain and the iteration
+        state to the checkpoint file. The file is written under a temporary
+        name and then moved into place, so a job killed while checkpointing
+        leaves the previous checkpoint intact.
+        """
+        filename = os.path.join(self.params.output_dir,
+                                self.params.checkpoint_file)
+        temp_filename = filename + '.tmp'
+        comm = self.mesh.comm
+        if comm.rank == 0 and not os.path.isdir(self.params.output_dir):
+            os.makedirs(self.params.output_dir)
+        comm.barrier()
+        with CheckpointFile(temp_filename, 'w', comm=comm) as f:
+            f.save_mesh(self.mesh)
+            f.require_group('/peryton')
+            self.problem.params.domain.save_metadata(f)
+            self.problem.params.domain.save_wall_distance(f)
+            for name, functions in self.diagnostic_variables.items():
+                f.save_function(functions[0])
+            f.set_attr('/peryton', 'fields',
+                       json.dumps([functions[0].name() for functions
+                                   in self.diagnostic_variables.values()]))
+            f.set_attr('/peryton', 't', self.t)
+            f.set_attr('/peryton', 'it_no', self.it_no)
+            f.set_attr('/peryton', 'dt', self.dt)
+            if self.residual_0 is not None:
+                f.set_attr('/peryton', 'residual_0', self.residual_0)
+        if comm.rank == 0:
+            os.rename(temp_filename, filename)
+        comm.barrier()
+
+
+    def load_checkpoint(self, filename, iteration_state=True):
+        """ Loads the diagnostic fields (and optionally the iteration state)
+        from a checkpoint file. Fields which are not in the file (e.g. those
+        of a turbulence model, starting from a laminar solution) keep their
+        current values. Returns the names of the fields loaded.
+
+        :param filename: The checkpoint file
+        :type filename: str
+        :param iteration_state: Whether to restore the time, iteration number
+            and timestep as well as the fields
+        :type iteration_state: bool
         """
-        for function in self.params.parameter_dictionary.keys():
-            if function in self.bcs.keys():
-                for condition in self.bcs[function]
-                    function.apply(condition)
+        loaded_names = []
+        with CheckpointFile(filename, 'r', comm=self.mesh.comm) as f:
+            fields = None
+            if checkpoint_has_attr(f, '/peryton', 'fields'):
+                fields = json.loads(f.get_attr('/peryton', 'fields'))
+            for name, functions in self.diagnostic_variables.items():
+                if fields is not None and functions[0].name() not in fields:
+                    continue
+                loaded = f.load_function(self.mesh, functions[0].name())
+                for function in functions:
+                    function.assign(loaded)
+                loaded_names.append(name)
+            if iteration_state:
+                # Older files may lack some of the iteration state
+                state = dict((key, f.get_attr('/peryton', key))
+                             for key in ['t', 'it_no', 'dt', 'residual_0']
+                             if checkpoint_has_attr(f, '/peryton', key))
+                self.t = state.get('t', 0)
+                self.it_no = state.get('it_no', 0)
+                if 'dt' in state:
+                    self.update_timestep(state['dt'])
+                if 'residual_0' in state:
+                    self.residual_0 = state['residual_0']
+            else:
+                self.t = 0
+                self.it_no = 0
+        info_out('Loaded checkpoint {} at iteration {}'\
+                 .format(filename, self.it_no))
+        missing = sorted(set(self.diagnostic_variables) - set(loaded_names))
+        if missing:
+            info_out('Not in the checkpoint: {}'.format(', '.join(missing)))
+        return loaded_names
 
 
+    @profile
     def dump_to_file(self):
         """ Dumps the solution prognostic and diagnostic fields to .pvd file.
+        The write itself happens in the background (see
+        :class:`AsyncFieldWriter`).
+        """
+        if self.output_writer is None:
+            names = sorted(self.diagnostic_variables.keys())
+            functions = [self.diagnostic_variables[name][0] for name in names]
+            labels = [self.params.variable_dictionary.get(name, name)
+                      for name in names]
+            filename = os.path.join(self.params.output_dir,
+                                    self.params.output_file)
+            self.output_writer = AsyncFieldWriter(filename, functions, labels,
+                                                 self.params.output_queue_size)
+        self.output_writer.write(self.t)
+
+
+    def add_probes(self, points, filename='probes.csv', variables=None,
+                   chunk_size=100):
+        """ Adds a set of points the diagnostic fields are sampled at every
+        iteration (see :class:`ProbeSet`). The points are located now.
+
+        :param points: The coordinates of the points, the same on every
+            process
+        :type points: array of shape (number of points, dimension)
+        :param filename: The .csv file in the output directory the values are
+            written to
+        :type filename: str
+        :param variables: The names of the variables to sample (defaults to
+            all the diagnostic variables)
+        :type variables: list of str
+        """
+        names = sorted(variables or self.diagnostic_variables.keys())
+        functions = [self.diagnostic_variables[name][0] for name in names]
+        probes = ProbeSet(self.mesh, points, functions, names,
+                          self.output_path(filename), chunk_size)
+        self.probes.append(probes)
+        self.probe_files.append(filename)
+        return probes
+
+
+    def output_path(self, filename):
+        """ Returns the path of a file in the (current) output directory, or
+        None if the filename is None
         """
-        output_file = self.params.output_file
-        # TODO there must be a way to work out what to write based on the param
-        # dict - but I can't work out how with the 'write' api.
-        temp_str = 'output_file.write('
-        for func in self.params.diagnostic_functions.keys():
-            temp_str += func + ', '
-        temp_str += 'time={})'.format(self.t)
-        exec(temp_str)
+        if filename is None:
+            return None
+        return os.path.join(self.params.output_dir, filename)
+
 
+    def update_probes(self):
+        """ Samples and records the fields at all the probe sets
+        """
+        for probes in self.probes:
+            probes.update(self.it_no, self.t)
 
 
+    def close_output(self):
+        """ Waits for any outstanding output to be written.
+        """
+        for probes in self.probes:
+            probes.flush()
+        if self.output_writer is not None:
+            self.output_writer.close()
+            self.output_writer = None
@@ -7,9 +7,22 @@
 """
 
 from firedrake import *
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from mpi4py import MPI
 from pyop2.profiling import timed_stage
+import csv
+import importlib
+import json
+import os
+import resource
+import subprocess
+import time
+import numpy as np
+
+
+# Make firedrake (or COFFEE really) a little less chatty
+set_log_level('CRITICAL')
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -50,6 +63,53 @@ def info_out(msg, colour=None, bold=False, underline=False, comm=COMM_WORLD):
         print(msg)
 
 
+def welcome(comm=COMM_WORLD):
+    """ Prints the welcome message (once per process)
+    """
+    global _welcomed
+    if _welcomed:
+        return
+    _welcomed = True
+    import peryton
+    info_out('\n\nPeryton \nSteady-state RANS solver\n', comm=comm)
+    info_out(time.strftime("%d/%m/%Y - %H:%M:%S") + ' Peryton version: ' \
+             + peryton.__version__, comm=comm)
+
+_welcomed = False
+
+
+def git_hash():
+    """ Returns the git hash code of the installation (computed once, on the
+    process that first asks for it)
+    """
+    global _git_hash
+    if _git_hash is None:
+        git_dir = os.path.join(os.path.dirname(os.path.dirname(
+                               os.path.abspath(__file__))), '.git')
+        try:
+            _git_hash = subprocess.check_output(['git', '--git-dir=' + git_dir,
+                                                 'rev-parse', 'HEAD'])\
+                                  .decode().strip()
+        except Exception:
+            _git_hash = 'Could not retrieve git hash code'
+    return _git_hash
+
+_git_hash = None
+
+
+def run_metadata(comm=COMM_WORLD):
+    """ Returns a dictionary describing the installation and the run. The git
+    hash is only looked up on rank 0 and then broadcast.
+    """
+    import peryton
+    label = git_hash() if comm.rank == 0 else None
+    return {'version': peryton.__version__,
+            'git_hash': comm.bcast(label, root=0),
+            'location': os.path.dirname(os.path.abspath(__file__)),
+            'date': time.strftime("%d/%m/%Y - %H:%M:%S"),
+            'n_processes': comm.size}
+
+
 # # # # # # # # # # # # # # # # # # # # # # # #
 #   F I R E D R A K E   E X T E N S I O N S   #
 # # # # # # # # # # # # # # # # # # # # # # # #
@@ -129,16 +189,163 @@ def get_function_space(function):
     return fs
 
 
+def checkpoint_has_attr(checkpoint, path, key):
+    """ Whether a checkpoint file has an attribute at a path. Unlike
+    :meth:`firedrake.CheckpointFile.has_attr` this is False, rather than a
+    KeyError, when the file does not have the group either (as files written
+    by older versions may not).
+
+    :param checkpoint: An open checkpoint file
+    :type checkpoint: :class:`firedrake.CheckpointFile`
+    """
+    return path in checkpoint.h5pyfile and checkpoint.has_attr(path, key)
+
+
 # # # # # # # # # # #
 # P R O F I L I N G #
 # # # # # # # # # # #
 
+class Profiler(object):
+    """ Collects the time spent in each stage of a run, iteration by
+    iteration, along with counters such as linear solver iterations.
+
+    Stage times are exclusive: time spent in a stage nested inside another
+    (e.g. a profiled method called within a stage) is counted for the inner
+    stage only, so the stages of an iteration add up to no more than its
+    duration.
+
+    Recording is local to each process and costs nothing in communication;
+    the statistics across processes are gathered once, by :meth:`report`,
+    with two batched reductions.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Forgets everything recorded so far
+        """
+        self.stage_names = []
+        self.counter_names = []
+        self.iterations = []
+        self._current = {}
+        # The time spent in the stages nested in each open stage
+        self._nested = []
+
+    @contextmanager
+    def stage(self, name):
+        """ Context manager timing a stage (which is also labelled for the
+        pyop2 profiler)
+        """
+        start = time.time()
+        self._nested.append(0.)
+        try:
+            with timed_stage(name):
+                yield
+        finally:
+            elapsed = time.time() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            if name not in self.stage_names:
+                self.stage_names.append(name)
+            self._current[name] = self._current.get(name, 0.) \
+                                  + elapsed - nested
+
+    def count(self, name, value):
+        """ Adds to a counter for the current iteration
+        """
+        if name not in self.counter_names:
+            self.counter_names.append(name)
+        self._current[name] = self._current.get(name, 0) + value
+
+    def end_iteration(self, it_no):
+        """ Files what has been recorded under the given iteration number
+        """
+        self.iterations.append((it_no, self._current))
+        self._current = {}
+
+    def report(self, comm=COMM_WORLD):
+        """ Returns the profile as a dictionary. Stage times are given as
+        their maximum over processes per iteration, and as totals with their
+        mean, maximum and load imbalance (max / mean) over processes. The peak
+        resident set size of each process is treated the same way.
+        """
+        if self._current:
+            self.end_iteration(None)
+        names = self.stage_names + self.counter_names
+        table = np.array([[record.get(name, 0.) for name in names]
+                          for it_no, record in self.iterations],
+                         dtype=float).reshape(len(self.iterations), len(names))
+        n_stages = len(self.stage_names)
+        totals = table[:, :n_stages].sum(axis=0)
+        # Peak RSS is reported in kilobytes on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+        local = np.concatenate([table.ravel(), totals, [rss]])
+        maxima = np.empty_like(local)
+        sums = np.empty_like(local)
+        comm.Allreduce(local, maxima, op=MPI.MAX)
+        comm.Allreduce(local, sums, op=MPI.SUM)
+        means = sums/comm.size
+
+        def statistics(i):
+            return {'mean': means[i], 'max': maxima[i],
+                    'imbalance': maxima[i]/means[i] if means[i] > 0 else 1.}
+
+        offset = table.size
+        iterations = []
+        for row, (it_no, record) in enumerate(self.iterations):
+            entry = OrderedDict([('iteration', it_no)])
+            for column, name in enumerate(names):
+                entry[name] = maxima[row*len(names) + column]
+            iterations.append(entry)
+
+        stages = OrderedDict((name, statistics(offset + i))
+                             for i, name in enumerate(self.stage_names))
+        return {'n_processes': comm.size,
+                'stages': stages,
+                'peak_rss_mb': statistics(offset + n_stages),
+                'iterations': iterations}
+
+    def write(self, directory, comm=COMM_WORLD, metadata=None):
+        """ Writes the report to profile.json and the per-iteration table to
+        profile.csv in the given directory (on rank 0)
+        """
+        report = self.report(comm)
+        if metadata is not None:
+            report['metadata'] = metadata
+        if comm.rank != 0:
+            return report
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'profile.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        with open(os.path.join(directory, 'profile.csv'), 'w',
+                  newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['iteration'] + self.stage_names
+                            + self.counter_names)
+            for entry in report['iterations']:
+                writer.writerow(entry.values())
+        return report
+
+
+# The profiler used by `profile` and the algorithms
+profiler = Profiler()
+
+
 def profile(func):
-    """ Decorator to automatically label stages for the pyopt profiler
+    """ Decorator to automatically label stages for the pyopt profiler, and
+    record them with the profiler. Methods are labelled with their class as
+    well as their name (e.g. `ProbeSet.update`), so they stay apart.
     """
     def func_wrapper(*args, **kwargs):
-        with timed_stage('{}'.format(func.__name__[:15])):
+        with profiler.stage(func.__qualname__):
             return func(*args, **kwargs)
+    func_wrapper.__name__ = func.__name__
+    func_wrapper.__qualname__ = func.__qualname__
+    func_wrapper.__doc__ = func.__doc__
     return func_wrapper
 
 
@@ -156,7 +363,7 @@ def import_path(fullpath):
     filename, ext = os.path.splitext(filename)
     sys.path.append(path)
     module = __import__(filename)
-    reload(module) # Might be out of date
+    importlib.reload(module) # Might be out of date
     del sys.path[-1]
     return module
 
@@ -5,7 +5,7 @@
 """
 
 from firedrake import *
-from helpers import info_out
+from .helpers import info_out
 
 
 class NS_InitialConditions(object):
@@ -14,10 +14,20 @@ class NS_InitialConditions(object):
 
     Users can pass a :class:`firedrake.expression`, :class:`firedrake.function`
     or float.
+
+    An initial guess can be set as well, in which case a linear problem --
+    'stokes' or 'potential' flow -- is solved with the actual boundary
+    conditions, starting from the initial conditions, and its solution is used
+    as the starting point instead.
+
+    The fields can also be taken from a checkpointed solution, which may be on
+    a different mesh (see :meth:`set_ic_from_checkpoint`).
     """
 
     def __init__(self):
-        pass
+        self.initial_guess = None
+        self.checkpoint_file = None
+        self.transfer_tolerance = None
 
 
     def process_initial_conditions(self):
@@ -33,7 +43,7 @@ class NS_InitialConditions(object):
         elif isinstance(value, constant.Constant):
             return value
         else:
-            raise TypeError, "Initial condition must be float, int or Constant"
+            raise TypeError("Initial condition must be float, int or Constant")
 
 
     def set_ic_u(self, value):
@@ -43,3 +53,33 @@ class NS_InitialConditions(object):
     def set_ic_p(self, value):
         self.ic_p = self._diagnose_input(value)
 
+
+    def set_ic_from_checkpoint(self, checkpoint_file, tolerance=None):
+        """ Takes the initial velocity and pressure from a checkpoint file,
+        interpolated onto the mesh of the run. Nodes outside the checkpointed
+        mesh keep the values of the initial conditions set with
+        :meth:`set_ic_u` and :meth:`set_ic_p`. Any initial guess is not solved
+        for.
+
+        :param checkpoint_file: The .h5 checkpoint file of the earlier run
+        :type checkpoint_file: str
+        :param tolerance: How far (relative to the cell size) outside the
+            checkpointed mesh a node can be and still take a value from it
+        :type tolerance: float
+        """
+        self.checkpoint_file = checkpoint_file
+        self.transfer_tolerance = tolerance
+
+
+    def set_initial_guess(self, mode):
+        """ Sets the linear problem solved for the initial guess.
+
+        :param mode: 'stokes', 'potential' or None to start from the initial
+            conditions as they are
+        :type mode: str
+        """
+        if mode not in [None, 'stokes', 'potential']:
+            raise ValueError("Initial guess must be 'stokes', 'potential' or "
+                             "None")
+        self.initial_guess = mode
+
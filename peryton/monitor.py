@@ -0,0 +1,222 @@
+"""
+.. module:: monitor
+   :synopsis: Monitors the convergence of the iterations and decides when to
+    stop them
+
+"""
+
+import os
+import numpy as np
+from firedrake import *
+from .helpers import *
+
+
+class CSVHistory(object):
+    """ A table of per-iteration values kept in a preallocated array of
+    `chunk_size` rows, which is appended to a .csv file (on rank 0) whenever
+    it fills up and when it is flushed.
+
+    :param comm: The communicator the values are shared on
+    :type comm: :class:`mpi4py.MPI.Comm`
+    :param filename: The .csv file (None keeps nothing)
+    :type filename: str
+    :param columns: The column names
+    :type columns: list of str
+    :param chunk_size: The number of rows written to disk at a time
+    :type chunk_size: int
+    """
+
+    def __init__(self, comm, filename, columns, chunk_size=100):
+
+        self.comm = comm
+        self.filename = filename
+        self.columns = columns
+        self.chunk = np.zeros((chunk_size, len(columns)))
+        self.reset()
+
+
+    def reset(self, new_file=True):
+        """ Starts a new table. The file, if any, is started again, unless
+        `new_file` is False: then the rows are appended to it.
+        """
+        self.n_rows = 0
+        self.file_started = not new_file
+
+
+    def append(self, row):
+        """ Adds a row, writing out the chunk if it is full
+        """
+        self.chunk[self.n_rows, :] = row
+        self.n_rows += 1
+        if self.n_rows == self.chunk.shape[0]:
+            self.flush()
+
+
+    def flush(self):
+        """ Appends the recorded rows to the file
+        """
+        if self.filename is not None and self.comm.rank == 0 \
+                and self.n_rows > 0:
+            new_file = not self.file_started \
+                       or not os.path.exists(self.filename)
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.filename, 'w' if new_file else 'a') as f:
+                if new_file:
+                    f.write(','.join(self.columns) + '\n')
+                np.savetxt(f, self.chunk[:self.n_rows], delimiter=',',
+                           fmt='%.10g')
+        self.file_started = True
+        self.n_rows = 0
+
+
+class ConvergenceMonitor(object):
+    """ Records the residuals and update norms of each iteration and checks
+    them against a list of stopping criteria.
+
+    The momentum and continuity residuals and the velocity and pressure update
+    norms are combined in a single reduction per iteration. The history is
+    written in chunks to a .csv file (see :class:`CSVHistory`). Each row is
+    labelled with the `stage` it belongs to, so the stages of a continuation
+    or nested iteration can share a file.
+
+    :param comm: The communicator the fields live on
+    :type comm: :class:`mpi4py.MPI.Comm`
+    :param filename: The .csv file the history is written to (None keeps it in
+        memory only)
+    :type filename: str
+    :param chunk_size: The number of iterations written to disk at a time
+    :type chunk_size: int
+    :param criteria: The stopping criteria, called in turn with the monitor
+    :type criteria: list of callables
+    """
+
+    columns = ['iteration', 't', 'dt', 'residual', 'momentum_residual',
+               'continuity_residual', 'velocity_update', 'pressure_update',
+               'stage']
+
+    def __init__(self, comm, filename=None, chunk_size=100, criteria=None):
+
+        self.comm = comm
+        self.history = CSVHistory(comm, filename, self.columns, chunk_size)
+        self.criteria = criteria if criteria is not None else []
+        self.stage = 0
+        self.reset()
+
+
+    def reset(self, new_file=True):
+        """ Starts a new history. The file, if any, is started again, unless
+        `new_file` is False: then the history is appended to it.
+        """
+        self.residual_0 = None
+        self.residuals = []
+        self.history.reset(new_file)
+
+
+    def update(self, it_no, t, dt, residual, velocity, pressure):
+        """ Records an iteration and returns the norm of the residual.
+
+        :param residual: The steady residual on the mixed velocity / pressure
+            space, with the strongly imposed entries zeroed
+        :type residual: :class:`firedrake.Function`
+        :param velocity: The velocity at this and the previous iteration
+        :type velocity: tuple of :class:`firedrake.Function`
+        :param pressure: The pressure at this and the previous iteration
+        :type pressure: tuple of :class:`firedrake.Function`
+        """
+        local = np.array([
+            np.sum(residual.dat[0].data_ro**2),
+            np.sum(residual.dat[1].data_ro**2),
+            np.sum((velocity[0].dat.data_ro - velocity[1].dat.data_ro)**2),
+            np.sum((pressure[0].dat.data_ro - pressure[1].dat.data_ro)**2)])
+        norms = np.empty_like(local)
+        self.comm.Allreduce(local, norms, op=MPI.SUM)
+        norms = np.sqrt(norms)
+        total = np.sqrt(norms[0]**2 + norms[1]**2)
+
+        if self.residual_0 is None:
+            self.residual_0 = total
+        self.residuals.append(total)
+
+        self.history.append([it_no, t, dt, total] + list(norms)
+                            + [self.stage])
+        return total
+
+
+    @property
+    def residual(self):
+        """ The latest residual norm
+        """
+        return self.residuals[-1]
+
+
+    def flush(self):
+        """ Appends the recorded rows to the history file
+        """
+        self.history.flush()
+
+
+    def check(self):
+        """ Applies the stopping criteria in turn and returns the first
+        verdict: a tuple of 'converged' or 'abort' and a message, or None to
+        carry on.
+        """
+        for criterion in self.criteria:
+            verdict = criterion(self)
+            if verdict is not None:
+                return verdict
+        return None
+
+
+class ToleranceCriterion(object):
+    """ Converged once the residual is below the absolute tolerance, or has
+    dropped by the relative tolerance from its first value.
+    """
+
+    def __init__(self, absolute_tolerance, relative_tolerance):
+        self.absolute_tolerance = absolute_tolerance
+        self.relative_tolerance = relative_tolerance
+
+    def __call__(self, monitor):
+        if monitor.residual <= self.absolute_tolerance:
+            return ('converged', 'Residual below the absolute tolerance')
+        if monitor.residual <= self.relative_tolerance*monitor.residual_0:
+            return ('converged', 'Residual below the relative tolerance')
+        return None
+
+
+class StagnationCriterion(object):
+    """ Aborts if the residual has not dropped by at least `min_reduction`
+    (a factor) over the last `window` iterations.
+    """
+
+    def __init__(self, window, min_reduction):
+        self.window = window
+        self.min_reduction = min_reduction
+
+    def __call__(self, monitor):
+        if len(monitor.residuals) <= self.window:
+            return None
+        old = monitor.residuals[-self.window - 1]
+        if monitor.residual > self.min_reduction*old:
+            return ('abort', 'Residual stagnated over the last {} iterations'\
+                             .format(self.window))
+        return None
+
+
+class DivergenceCriterion(object):
+    """ Aborts if the residual is not finite or has grown by more than
+    `factor` over its first value.
+    """
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __call__(self, monitor):
+        if not np.isfinite(monitor.residual):
+            return ('abort', 'Residual is not finite')
+        if monitor.residual > self.factor*monitor.residual_0:
+            return ('abort', 'Residual has grown by more than {:g}'\
+                             .format(self.factor))
+        return None
@@ -1 +1 @@
-from algorithm_ns import *
+from .algorithm_ns import *
@@ -5,13 +5,74 @@
 
 """
 
+import copy
 from firedrake import *
 from ..helpers import *
-from backend_ns import NS_Backend, NS_BackendParameters
+from ..problem import Problem
+from ..monitor import *
+from ..diagnostics import FacetDiagnostics
+from .backend_ns import NS_Backend, NS_BackendParameters
 
 class NS_AlgorithmParameters(NS_BackendParameters):
 
-    pass
+    # Pseudo-timestep control. With switched evolution relaxation (SER) the
+    # timestep is scaled by the ratio of successive steady residuals, limited
+    # to a factor of `dt_growth_limit` per iteration and to at most `dt_max`.
+    # The timestep set in the problem parameters is the initial (and minimum)
+    # value.
+    adaptive_timestep = True
+    dt_growth_limit = 2.0
+    dt_max = 1.0e8
+
+    # The run stops once the steady residual is below the absolute tolerance
+    # or has dropped by the relative tolerance from its initial value
+    absolute_tolerance = 1.0e-12
+    relative_tolerance = 1.0e-6
+
+    # The run is aborted if the residual has not dropped by a factor of
+    # `stagnation_reduction` over `stagnation_window` iterations (a window of
+    # 0 disables this), or has grown by `divergence_factor` over its initial
+    # value. Further criteria (callables taking the
+    # :class:`ConvergenceMonitor`) can be added to `stopping_criteria`.
+    stagnation_window = 0
+    stagnation_reduction = 0.99
+    divergence_factor = 1.0e6
+    stopping_criteria = []
+
+    # The residual and update norm history is written to `history_file` in
+    # the output directory, `history_chunk_size` iterations at a time (None
+    # keeps it in memory only)
+    history_file = 'history.csv'
+    history_chunk_size = 100
+
+    # Integrated quantities on the labelled facets (mass flux through the
+    # inlets and outlets, mean pressure drop and wall forces) are written to
+    # `diagnostics_file` in the output directory every iteration (None
+    # disables them)
+    diagnostics_file = None
+
+    # Viscosity continuation (see `NS_Algorithm.run_continuation`). The
+    # viscosity is stepped geometrically from `continuation_nu_start` to the
+    # problem's nu over `continuation_stages` further stages. The intermediate
+    # stages are only converged to `continuation_relative_tolerance`.
+    continuation_nu_start = None
+    continuation_stages = 4
+    continuation_relative_tolerance = 1.0e-3
+
+    # Nonlinear solver: 'picard' marches the Oseen linearisation in
+    # pseudo-time; 'newton' starts the same way and switches to steady Newton
+    # steps with a backtracking line search after `newton_switch_iterations`
+    # Picard iterations, or sooner once the residual has dropped by
+    # `newton_switch_tolerance`. The line search halves the step at most
+    # `line_search_max_backtracks` times.
+    nonlinear_solver = 'picard'
+    newton_switch_iterations = 5
+    newton_switch_tolerance = 1.0e-2
+    line_search_max_backtracks = 8
+
+    # Nested iteration (see `NS_Algorithm.run_nested`). The coarser levels of
+    # the mesh hierarchy are only converged to `nested_relative_tolerance`.
+    nested_relative_tolerance = 1.0e-3
 
 
 class NS_Algorithm(NS_Backend):
@@ -21,31 +82,369 @@ class NS_Algorithm(NS_Backend):
 
     def __init__(self, parameters, problem):
 
+        welcome()
+
         # Initialise the base class
         super(NS_Algorithm, self).__init__(parameters, problem)
 
         self.params = parameters
         self.problem = problem
+        self.operator_age = None
+        self.newton = False
+
+        # The files are found from the output directory at the start of each
+        # run (see `set_output_files`)
+        self.monitor = ConvergenceMonitor(self.mesh.comm, None,
+                                          self.params.history_chunk_size)
+
+        self.diagnostics = None
+        if self.params.diagnostics_file is not None:
+            self.diagnostics = FacetDiagnostics(
+                                   self.domain, self.u_n, self.p_n, self.nu,
+                                   self.rho, None,
+                                   self.params.history_chunk_size)
 
 
     @staticmethod
     def default_parameters():
         """ Returns an instance of the default parameters set
         """
-        return NS_AlgorithmParameters
+        return NS_AlgorithmParameters()
 
 
-    def run(self):
+    def run(self, initialise=True, relative_tolerance=None, new_history=True,
+            stage=0):
         """ Runs the XXX algorithm
+
+        :param initialise: Start from the initial conditions (or the restart
+            file). Otherwise the run continues from the current fields,
+            timestep and lagged operator, and the relative tolerance is
+            measured against `residual_0` if that has been set.
+        :type initialise: bool
+        :param relative_tolerance: Overrides the relative tolerance in the
+            parameters
+        :type relative_tolerance: float
+        :param new_history: Start the residual, diagnostics and probe files
+            again. Otherwise the run is appended to them.
+        :type new_history: bool
+        :param stage: The stage of a continuation or nested iteration the run
+            is, recorded in the residual history
+        :type stage: int
         """
+        if relative_tolerance is None:
+            relative_tolerance = self.params.relative_tolerance
+        self.relative_tolerance = relative_tolerance
+        if self.params.nonlinear_solver not in ['picard', 'newton']:
+            raise ValueError("Unknown nonlinear solver: {}. Choose from "
+                             "'picard', 'newton'"\
+                             .format(self.params.nonlinear_solver))
+        profiler.reset()
+        # Every run starts with Picard iterations
+        self.set_newton(False)
 
-        # Set initial conditions
-        self.apply_intial_conditions()
+        # Set initial conditions, or pick up from a checkpoint
+        if not initialise:
+            self.t = 0
+            self.it_no = 0
+        elif self.params.restart_file:
+            self.residual_0 = None
+            self.operator_age = None
+            self.load_checkpoint(self.params.restart_file,
+                                 self.params.restart_iteration_state)
+        else:
+            self.residual_0 = None
+            self.operator_age = None
+            self.t = 0
+            self.it_no = 0
+            self.update_timestep(self.problem.params.dt)
+            self.apply_initial_conditions()
 
         # Apply boundary conditions
         self.apply_boundary_conditions()
 
         # Write ICs to file
-
+        if self.params.output_frequency:
+            self.dump_to_file()
 
         # Begin iterating
+        self.set_output_files()
+        self.monitor.reset(new_history)
+        self.monitor.stage = stage
+        self.monitor.criteria = self.get_stopping_criteria()
+        self.residual = self.update_monitor()
+        if self.residual_0 is None:
+            self.residual_0 = self.residual
+        self.monitor.residual_0 = self.residual_0
+        if self.diagnostics is not None:
+            self.diagnostics.reset(new_history)
+            self.diagnostics.update(self.it_no, self.t)
+        for probes in self.probes:
+            probes.reset(new_history)
+        self.update_probes()
+        info_out('Initial residual: {:.3e}'.format(self.residual))
+        profiler.end_iteration(self.it_no)
+
+        self.converged = False
+        self.residual_ratio = 0.
+        verdict = None
+        first_iteration = self.it_no + 1
+        for self.it_no in range(first_iteration,
+                                self.problem.params.max_iterations + 1):
+            residual_nminus1 = self.residual
+            if not self.newton \
+                    and self.newton_is_due(self.it_no - first_iteration):
+                info_out('Switching to Newton at iteration {}'\
+                         .format(self.it_no), colour='blue')
+                self.set_newton(True)
+            # Newton steps always need the current Jacobian
+            rebuild_operator = self.newton or self.operator_is_stale()
+            if rebuild_operator:
+                self.operator_age = 0
+            self.operator_age += 1
+            self.solve_timestep(rebuild_operator)
+            if self.newton:
+                step = self.velocity_pressure_solver.line_search(
+                           residual_nminus1,
+                           self.params.line_search_max_backtracks)
+                profiler.count('line_search_step', step)
+            self.residual = self.update_monitor()
+            if residual_nminus1 > 0:
+                self.residual_ratio = self.residual/residual_nminus1
+            info_out('Iteration {}: residual {:.3e}, dt {:.3e}'\
+                     .format(self.it_no, self.residual, self.dt))
+            if self.diagnostics is not None:
+                self.diagnostics.update(self.it_no, self.t)
+            self.update_probes()
+
+            if self.params.output_frequency \
+                    and self.it_no % self.params.output_frequency == 0:
+                self.dump_to_file()
+
+            verdict = self.monitor.check()
+            if verdict is not None:
+                profiler.end_iteration(self.it_no)
+                status, message = verdict
+                self.converged = status == 'converged'
+                if self.converged:
+                    info_out('{}: converged in {} iterations'\
+                             .format(message, self.it_no), colour='green')
+                else:
+                    info_out('{}: aborted after {} iterations'\
+                             .format(message, self.it_no), colour='red')
+                break
+
+            if self.params.adaptive_timestep and not self.newton:
+                self.update_timestep(self.get_ser_timestep(residual_nminus1))
+
+            if self.params.checkpoint_frequency \
+                    and self.it_no % self.params.checkpoint_frequency == 0:
+                self.write_checkpoint()
+
+            profiler.end_iteration(self.it_no)
+
+        if verdict is None:
+            info_out('Not converged after {} iterations'.format(self.it_no),
+                     colour='red')
+        self.monitor.flush()
+        if self.diagnostics is not None:
+            self.diagnostics.flush()
+
+        # Checkpoint the final state, e.g. to warm start a neighbouring case
+        if self.params.checkpoint_frequency:
+            self.write_checkpoint()
+
+        # Make sure all the output has been written
+        self.close_output()
+
+        if self.params.profile_report:
+            comm = self.mesh.comm
+            profiler.write(self.params.output_dir, comm=comm,
+                           metadata=run_metadata(comm))
+
+
+    def run_nested(self):
+        """ Runs the algorithm by nested iteration over the domain's mesh
+        hierarchy: the problem is converged on the coarsest level, prolonged
+        to the next level as its starting point, and so on up to this
+        algorithm's (finest) level.
+
+        On every level the relative tolerance is measured against the residual
+        of the initial conditions on that level, so the finer levels only have
+        to remove what is left after the prolongation. The coarser levels are
+        converged to `nested_relative_tolerance` and write no output apart
+        from their residual history: every level is recorded in the history
+        file, with the level as the stage.
+        """
+        domain = self.problem.params.domain
+        if domain.hierarchy is None:
+            raise ValueError("Nested iteration needs a domain with a mesh "
+                             "hierarchy (see SimpleDomain)")
+        n_levels = len(domain.hierarchy)
+
+        parameters = copy.copy(self.params)
+        parameters.output_frequency = 0
+        parameters.checkpoint_frequency = 0
+        parameters.restart_file = None
+        parameters.diagnostics_file = None
+
+        coarse = None
+        for level in range(n_levels):
+            info_out('Nested iteration level {} of {}'\
+                     .format(level + 1, n_levels), colour='blue')
+            if level == n_levels - 1:
+                algorithm = self
+                relative_tolerance = None
+            else:
+                problem_parameters = copy.copy(self.problem.params)
+                problem_parameters.domain = domain.level(level)
+                algorithm = NS_Algorithm(parameters,
+                                         Problem(problem_parameters))
+                relative_tolerance = self.params.nested_relative_tolerance
+
+            if coarse is None:
+                algorithm.run(relative_tolerance=relative_tolerance, stage=0)
+            else:
+                # Reference residual from the initial condition expressions on
+                # this level (no initial guess, which would be thrown away)
+                algorithm.update_timestep(self.problem.params.dt)
+                algorithm.apply_initial_conditions(initial_guess=False)
+                algorithm.apply_boundary_conditions()
+                algorithm.residual_0 = algorithm.get_residual()
+
+                prolong(coarse.u_n, algorithm.u_n)
+                prolong(coarse.p_n, algorithm.p_n)
+                algorithm.operator_age = None
+                algorithm.update_timestep(coarse.dt)
+                algorithm.run(initialise=False,
+                              relative_tolerance=relative_tolerance,
+                              new_history=False, stage=level)
+            coarse = algorithm
+
+
+    def set_output_files(self):
+        """ Points the residual history, diagnostics and probe files at the
+        current output directory, which can change between runs -- e.g. from
+        case to case of a :class:`ParameterSweep`.
+        """
+        self.monitor.history.filename = \
+            self.output_path(self.params.history_file)
+        if self.diagnostics is not None:
+            self.diagnostics.history.filename = \
+                self.output_path(self.params.diagnostics_file)
+        for probes, filename in zip(self.probes, self.probe_files):
+            probes.history.filename = self.output_path(filename)
+
+
+    def update_monitor(self):
+        """ Records the current iteration with the convergence monitor and
+        returns the norm of the steady residual.
+        """
+        return self.monitor.update(
+                   self.it_no, self.t, self.dt,
+                   self.velocity_pressure_solver.assemble_residual(),
+                   (self.u_n, self.u_nminus1), (self.p_n, self.p_nminus1))
+
+
+    def get_stopping_criteria(self):
+        """ The stopping criteria for a run, from the parameters.
+        """
+        criteria = [ToleranceCriterion(self.params.absolute_tolerance,
+                                       self.relative_tolerance),
+                    DivergenceCriterion(self.params.divergence_factor)]
+        if self.params.stagnation_window:
+            criteria.append(StagnationCriterion(
+                                self.params.stagnation_window,
+                                self.params.stagnation_reduction))
+        return criteria + list(self.params.stopping_criteria)
+
+
+    def run_continuation(self):
+        """ Runs the algorithm as a continuation in viscosity -- i.e. in
+        Reynolds number.
+
+        The first stage, at `continuation_nu_start`, starts from the initial
+        conditions. Each further stage lowers the viscosity and starts from the
+        previous stage's fields and timestep, reusing its operator and
+        preconditioner until the operator lag rebuilds them (the cached
+        viscous operator is refreshed then). The stages share the history
+        files, and are told apart by the stage column of the residual
+        history.
+        """
+        nu_target = float(self.problem.params.nu)
+        nu_start = self.params.continuation_nu_start
+        if nu_start is None:
+            raise ValueError("continuation_nu_start must be set")
+        n_stages = self.params.continuation_stages
+        nu_values = [nu_start*(nu_target/nu_start)**(float(i)/n_stages)
+                     for i in range(n_stages + 1)]
+
+        total_iterations = 0
+        for stage, nu in enumerate(nu_values):
+            info_out('Continuation stage {} of {}: nu = {:.3e}'\
+                     .format(stage + 1, len(nu_values), nu), colour='blue')
+            self.nu.assign(nu)
+            self.velocity_pressure_solver.invalidate_constant_operators()
+            self.residual_0 = None
+            if stage == n_stages:
+                relative_tolerance = None
+            else:
+                relative_tolerance = \
+                    self.params.continuation_relative_tolerance
+            self.run(initialise=(stage == 0),
+                     relative_tolerance=relative_tolerance,
+                     new_history=(stage == 0), stage=stage)
+            total_iterations += self.it_no
+        info_out('Continuation took {} iterations in total'\
+                 .format(total_iterations))
+
+
+    def set_newton(self, newton):
+        """ Switches between Picard (pseudo-timestep) and Newton iterations.
+        The operator is rebuilt for the next solve if the kind of iteration
+        changes.
+
+        :param newton: Whether to take Newton steps
+        :type newton: bool
+        """
+        if newton != self.newton:
+            self.operator_age = None
+        self.newton = newton
+        self.velocity_pressure_solver.set_newton(newton)
+
+
+    def newton_is_due(self, picard_iterations):
+        """ Decides whether to switch from Picard to Newton iterations, given
+        the number of Picard iterations taken in this run.
+        """
+        if self.params.nonlinear_solver != 'newton':
+            return False
+        if picard_iterations >= self.params.newton_switch_iterations:
+            return True
+        return self.residual <= self.params.newton_switch_tolerance \
+                                *self.residual_0
+
+
+    def operator_is_stale(self):
+        """ Decides whether the lagged operator and preconditioner should be
+        rebuilt before the next solve.
+        """
+        if self.operator_age is None:
+            return True
+        lag = self.params.operator_lag
+        if lag and self.operator_age >= lag:
+            return True
+        stall_ratio = self.params.operator_stall_ratio
+        return stall_ratio is not None and self.residual_ratio > stall_ratio
+
+
+    def get_ser_timestep(self, residual_nminus1):
+        """ Returns the next pseudo-timestep from switched evolution relaxation
+        -- i.e. the current timestep scaled by the reduction in the residual.
+        """
+        if self.residual == 0:
+            growth = self.params.dt_growth_limit
+        else:
+            growth = min(residual_nminus1/self.residual,
+                         self.params.dt_growth_limit)
+        dt = min(self.dt*growth, self.params.dt_max)
+        return max(dt, self.problem.params.dt)
@@ -7,11 +7,63 @@
 from firedrake import *
 from ..helpers import *
 from ..generic_backend import *
+from ..solvers import VelocityPressureSolver, InitialGuessSolver, \
+                      SpalartAllmarasSolver
 
 class NS_BackendParameters(GenericBackendParameters):
 
     variable_dictionary = {'u': 'Velocity',
-                           'p': 'Pressure'}
+                           'p': 'Pressure',
+                           'nu_tilde': 'Spalart-Allmaras variable'}
+
+    # Velocity / pressure linear solver: the name of one of the solver presets
+    # ('direct', 'schur_lsc', 'schur_gmg', 'schur_pcd', 'schur_pcd_p1') or a
+    # dictionary of PETSc options
+    solver_params = 'direct'
+    # Matrix type of the velocity / pressure operator ('aij', 'nest' or
+    # 'matfree'), overriding that of the solver options (None keeps it). A
+    # matrix-free operator is never assembled; assembled preconditioners are
+    # wrapped so that only they assemble a matrix.
+    mat_type = None
+
+    # Velocity / pressure element pair: 'P2-P1' (Taylor-Hood) or 'P1-P1'
+    # (equal order, stabilised with PSPG / SUPG terms) -- the latter has far
+    # fewer velocity degrees of freedom and a sparser system, for cheap
+    # screening runs
+    element_pair = 'P2-P1'
+
+    # Lagging of the velocity / pressure operator. The operator, and with it
+    # the preconditioner setup, is rebuilt every `operator_lag` iterations and
+    # whenever an iteration reduces the residual by less than the
+    # `operator_stall_ratio` (None disables this). With an `operator_lag` of 0
+    # the operator is only rebuilt when the residual stalls.
+    operator_lag = 1
+    operator_stall_ratio = None
+
+    # Local pseudo-timestepping. Rather than a single global timestep, each
+    # cell takes the timestep set by a CFL number based on its size, the local
+    # velocity and the viscosity: dt = CFL h / (|u| + 2 nu / h). The CFL
+    # number starts at `cfl` and is scaled with the global (e.g. SER) timestep
+    # relative to its initial value.
+    local_timestepping = False
+    cfl = 1.0
+
+    # Turbulence model: None (laminar) or 'spalart_allmaras'. The model's
+    # working variable is solved for on CG `turbulence_degree`, with the
+    # velocity held fixed, and sets the turbulent viscosity of the momentum
+    # equations. Its inflow value is `turbulence_inflow_ratio` times the
+    # viscosity. It is updated after every `turbulence_update_frequency`-th
+    # flow iteration, by `turbulence_subcycles` pseudo-timesteps at a time.
+    turbulence_model = None
+    turbulence_degree = 1
+    turbulence_inflow_ratio = 3.0
+    turbulence_update_frequency = 1
+    turbulence_subcycles = 1
+
+
+# The velocity degree, pressure degree and whether the pair is stabilised
+element_pairs = {'P2-P1': (2, 1, False),
+                 'P1-P1': (1, 1, True)}
 
 
 class NS_Backend(GenericBackend):
@@ -25,18 +77,40 @@ class NS_Backend(GenericBackend):
 
         self.params = parameters
         self.problem = problem
-        self.mesh = problem.domain.mesh
+        self.domain = problem.params.domain
+        self.mesh = self.domain.mesh
 
         # Set up the function spaces for velocity and pressure
-        self.V = VectorFunctionSpace(self.mesh, 'CG', 2)
-        self.Q = FunctionSpace(self.mesh, 'CG', 1)
+        if self.params.element_pair not in element_pairs:
+            raise ValueError("Unknown element pair: {}. Choose from {}"\
+                             .format(self.params.element_pair,
+                                     sorted(element_pairs.keys())))
+        degree_u, degree_p, self.stabilised = \
+            element_pairs[self.params.element_pair]
+        self.V = VectorFunctionSpace(self.mesh, 'CG', degree_u)
+        self.Q = FunctionSpace(self.mesh, 'CG', degree_p)
+
+        # Physical constants
+        self.nu = Constant(problem.params.nu)
+        self.rho = Constant(problem.params.rho)
+
+        self.initialise_functions()
+        info_out('Velocity: {0[0]}{0[1]}, pressure: {1[0]}{1[1]}{2}, {3} '
+                 'degrees of freedom'.format(get_function_space(self.u_n),
+                                             get_function_space(self.p_n),
+                                             ' (stabilised)' if self.stabilised
+                                             else '',
+                                             self.V.dim() + self.Q.dim()))
+        if self.params.local_timestepping:
+            self.initialise_local_timestep()
+        self.initialise_solvers()
 
 
     @staticmethod
     def default_parameters():
         """ Returns an instance of the default parameters set
         """
-        return BackendNSParameters()
+        return NS_BackendParameters()
 
 
     def initialise_functions(self):
@@ -56,3 +130,193 @@ class NS_Backend(GenericBackend):
         self.diagnostic_variables = {'u': [self.u_n, self.u_nminus1],
                                      'p': [self.p_n, self.p_nminus1]}
 
+        # Turbulence model functions
+        if self.params.turbulence_model is None:
+            self.nu_T = Constant(0)
+        elif self.params.turbulence_model == 'spalart_allmaras':
+            self.T = FunctionSpace(mesh, 'CG', self.params.turbulence_degree)
+            self.nu_tilde = Function(self.T, name='nu_tilde')
+            self.nu_T = Function(self.T, name='nu_T')
+            self.diagnostic_variables['nu_tilde'] = [self.nu_tilde]
+        else:
+            raise ValueError("Unknown turbulence model: {}"\
+                             .format(self.params.turbulence_model))
+
+
+    def initialise_local_timestep(self):
+        """ Replaces the global timestep with a piecewise constant field of
+        local timesteps
+        """
+        h = CellDiameter(self.mesh)
+        self.cfl = Constant(self.params.cfl)
+        self.Dt = Function(FunctionSpace(self.mesh, 'DG', 0), name='Dt')
+        self.local_timestep = self.cfl*h \
+                              /(sqrt(inner(self.u_n, self.u_n)) + 2*self.nu/h)
+        self.update_local_timestep()
+
+
+    @profile
+    def update_local_timestep(self):
+        """ Recomputes the local timesteps from the current velocity
+        """
+        self.Dt.interpolate(self.local_timestep)
+
+
+    def update_timestep(self, dt):
+        """ Sets the size of the next pseudo-timestep. With local timestepping
+        this scales the CFL number instead.
+        """
+        if not self.params.local_timestepping:
+            return super(NS_Backend, self).update_timestep(dt)
+        self.dt = dt
+        self.cfl.assign(self.params.cfl*dt/self.problem.params.dt)
+        self.update_local_timestep()
+
+
+    def initialise_solvers(self):
+        """ Make the velocity / pressure solver, and the turbulence model
+        solver if there is one
+        """
+        self.turbulence_solver = None
+        if self.params.turbulence_model is not None:
+            inflow = Constant(self.params.turbulence_inflow_ratio)*self.nu
+            bcs = [DirichletBC(self.T, Constant(0),
+                               tuple(self.domain.wall_list))]
+            if self.domain.inlet_list:
+                bcs.append(DirichletBC(self.T, inflow,
+                                       tuple(self.domain.inlet_list)))
+            self.turbulence_inflow = inflow
+            self.turbulence_solver = SpalartAllmarasSolver(
+                                         self.T, self.nu_tilde, self.u_n,
+                                         self.nu, self.domain.wall_distance(),
+                                         self.Dt, bcs)
+            self.turbulence_solver.get_solvers()
+
+        self.velocity_pressure_solver = VelocityPressureSolver(
+            self.domain, self.V, self.Q, self.bcs,
+            self.problem.params.body_forces, self.nu, self.u_n, self.p_n,
+            self.Dt, turbulent_viscosity=self.nu_T,
+            solver_params=self.params.solver_params,
+            mat_type=self.params.mat_type, stabilised=self.stabilised)
+        self.velocity_pressure_solver.get_solvers()
+
+
+    def apply_initial_conditions(self, initial_guess=True):
+        """ Applies the initial conditions, then replaces them with the
+        solution of the linear initial guess problem if one has been set (and
+        they are not transferred from a checkpoint). The turbulence model
+        starts from its inflow value.
+
+        :param initial_guess: Solve for the initial guess, or transfer the
+            fields from a checkpoint. Otherwise only the initial condition
+            expressions are applied.
+        :type initial_guess: bool
+        """
+        super(NS_Backend, self).apply_initial_conditions(initial_guess)
+        if self.turbulence_solver is not None:
+            self.nu_tilde.interpolate(self.turbulence_inflow)
+            self.update_turbulent_viscosity()
+        mode = getattr(self.ics, 'initial_guess', None)
+        if not initial_guess or mode is None \
+                or getattr(self.ics, 'checkpoint_file', None):
+            return
+        info_out('Solving for a {} flow initial guess'.format(mode))
+        InitialGuessSolver(self.V, self.Q, self.bcs,
+                           self.problem.params.body_forces, self.nu,
+                           self.u_n, self.p_n,
+                           solver_params=self.params.solver_params,
+                           stabilised=self.stabilised)\
+            .solve(mode)
+        self.u_nminus1.assign(self.u_n)
+        self.p_nminus1.assign(self.p_n)
+
+
+    def load_checkpoint(self, filename, iteration_state=True):
+        """ Loads the diagnostic fields (and optionally the iteration state)
+        from a checkpoint file, and the turbulent viscosity with them. A
+        checkpoint without the turbulence model (e.g. of a laminar run)
+        starts the model from its inflow value.
+        """
+        loaded = super(NS_Backend, self).load_checkpoint(filename,
+                                                         iteration_state)
+        if self.turbulence_solver is not None and 'nu_tilde' not in loaded:
+            self.nu_tilde.interpolate(self.turbulence_inflow)
+        self.update_turbulent_viscosity()
+        return loaded
+
+
+    def update_turbulent_viscosity(self):
+        """ Sets the turbulent viscosity from the turbulence model
+        """
+        if self.turbulence_solver is not None:
+            self.turbulence_solver.update_turbulent_viscosity(self.nu_T)
+
+
+    def update_turbulence(self):
+        """ Advances the turbulence model (with the velocity held fixed) and
+        updates the turbulent viscosity, on the iterations it is scheduled
+        for.
+        """
+        if self.turbulence_solver is None \
+                or self.it_no % self.params.turbulence_update_frequency:
+            return
+        with profiler.stage('turbulence'):
+            self.turbulence_solver.solve(self.params.turbulence_subcycles)
+            self.update_turbulent_viscosity()
+
+
+    def set_problem(self, problem):
+        """ Switch to a variation of the problem on the same domain. The mesh,
+        function spaces and functions are reused, and so is the solver unless
+        the boundary conditions or body forces have been replaced.
+
+        :param problem: The new problem
+        :type problem: :class:`Problem`
+        """
+        if problem.params.domain is not self.domain:
+            raise ValueError("The new problem must be on the same domain")
+        body_forces = self.problem.params.body_forces
+        rebuild_solver = problem.params.bcs is not self.bcs \
+            or problem.params.body_forces is not body_forces
+
+        self.problem = problem
+        self.ics = problem.params.ics
+        self.bcs = problem.params.bcs
+        self.nu.assign(problem.params.nu)
+        self.rho.assign(problem.params.rho)
+
+        if rebuild_solver:
+            self.initialise_solvers()
+        else:
+            # The background viscosity is part of the cached operators
+            self.velocity_pressure_solver.invalidate_constant_operators()
+
+
+    def solve_timestep(self, rebuild_operator=True):
+        """ Advances the velocity and pressure by one pseudo-timestep.
+
+        :param rebuild_operator: Reassemble the operator and its preconditioner
+            rather than reusing the lagged ones
+        :type rebuild_operator: bool
+        """
+        self.u_nminus1.assign(self.u_n)
+        self.p_nminus1.assign(self.p_n)
+        if self.params.local_timestepping:
+            self.update_local_timestep()
+        if self.bcs.time_dependent:
+            # Move the state onto the boundary values at the new time
+            with profiler.stage('update_boundary_conditions'):
+                self.bcs.update(self.t + self.dt)
+                for bc in self.bcs.get_dirichlet_bcs('u', self.V):
+                    bc.apply(self.u_n)
+                for bc in self.bcs.get_dirichlet_bcs('p', self.Q):
+                    bc.apply(self.p_n)
+        self.velocity_pressure_solver.solve(rebuild_operator)
+        self.update_turbulence()
+        self.t += self.dt
+
+
+    def get_residual(self):
+        """ Returns the norm of the steady residual at the current state.
+        """
+        return self.velocity_pressure_solver.get_residual()
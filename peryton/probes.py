@@ -0,0 +1,107 @@
+"""
+.. module:: probes
+   :synopsis: Samples fields at a fixed set of points every iteration
+
+"""
+
+import numpy as np
+from firedrake import *
+from .helpers import *
+from .monitor import CSVHistory
+
+
+class ProbeSet(object):
+    """ Records the values of fields at a set of points -- e.g. the sensor
+    locations of a rig -- every iteration.
+
+    The points are located once, when the probe set is made: each point is
+    owned by the process whose cell contains it, and the cells and reference
+    coordinates are kept by a :class:`firedrake.VertexOnlyMesh`. Each update
+    is then one interpolation per field onto the points, and one gather of the
+    values onto rank 0 in the order the points were given. The values are
+    written in chunks to a .csv file (see :class:`CSVHistory`) with a column
+    per point and field component.
+
+    :param mesh: The mesh the fields live on
+    :type mesh: :class:`firedrake.Mesh`
+    :param points: The coordinates of the points, the same on every process
+    :type points: array of shape (number of points, dimension)
+    :param functions: The fields
+    :type functions: list of :class:`firedrake.Function`
+    :param names: The names of the fields, used in the column names
+    :type names: list of str
+    :param filename: The .csv file (None keeps nothing)
+    :type filename: str
+    """
+
+    def __init__(self, mesh, points, functions, names, filename=None,
+                 chunk_size=100):
+
+        self.comm = mesh.comm
+        self.points = np.asarray(points, dtype=float)
+        self.functions = functions
+        with profiler.stage('locate_probes'):
+            self.vom = VertexOnlyMesh(mesh, self.points, redundant=True,
+                                      missing_points_behaviour='error')
+
+        self.interpolators = []
+        self.values = []
+        columns = []
+        for function, name in zip(functions, names):
+            shape = function.ufl_shape
+            if shape:
+                P0 = VectorFunctionSpace(self.vom, 'DG', 0, dim=shape[0])
+                P0_input = VectorFunctionSpace(self.vom.input_ordering, 'DG',
+                                               0, dim=shape[0])
+                columns.append(['{}_{}'.format(name, component)
+                                for component in 'xyz'[:shape[0]]])
+            else:
+                P0 = FunctionSpace(self.vom, 'DG', 0)
+                P0_input = FunctionSpace(self.vom.input_ordering, 'DG', 0)
+                columns.append([name])
+            at_points = Function(P0)
+            in_order = Function(P0_input)
+            self.interpolators.append((Interpolator(function, P0),
+                                       Interpolator(at_points, P0_input)))
+            self.values.append((at_points, in_order))
+
+        # Point by point, the components of each field in turn
+        self.columns = ['iteration', 't'] \
+                       + ['{}_{}'.format(column, i)
+                          for i in range(len(self.points))
+                          for field_columns in columns
+                          for column in field_columns]
+        self.history = CSVHistory(self.comm, filename, self.columns,
+                                  chunk_size)
+
+
+    def reset(self, new_file=True):
+        """ Starts a new history, appending to the file if `new_file` is
+        False
+        """
+        self.history.reset(new_file)
+
+
+    @profile
+    def update(self, it_no, t):
+        """ Samples the fields and records them. Returns the values on rank 0,
+        as an array with a row per point, and None elsewhere.
+        """
+        for (to_points, to_input_order), (at_points, in_order) \
+                in zip(self.interpolators, self.values):
+            to_points.interpolate(output=at_points)
+            to_input_order.interpolate(output=in_order)
+
+        if self.comm.rank != 0:
+            return None
+        values = np.column_stack([in_order.dat.data_ro.reshape(
+                                      len(self.points), -1)
+                                  for at_points, in_order in self.values])
+        self.history.append(np.concatenate([[it_no, t], values.ravel()]))
+        return values
+
+
+    def flush(self):
+        """ Appends the recorded rows to the file
+        """
+        self.history.flush()
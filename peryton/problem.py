@@ -4,7 +4,7 @@
 
 """
 
-from helpers import *
+from .helpers import *
 
 class ProblemParameters(FrozenClass):
     """
@@ -1 +1,3 @@
-from velocity_pressure_solver import *
+from .velocity_pressure_solver import *
+from .initial_guess_solver import *
+from .spalart_allmaras_solver import *
@@ -0,0 +1,131 @@
+"""
+.. module:: initial_guess_solver
+   :synopsis: Linear problems (Stokes and potential flow) solved for the
+    initial guess of the velocity / pressure iterations
+
+"""
+
+from collections import OrderedDict
+from firedrake import *
+from ..helpers import *
+from .velocity_pressure_solver import solver_presets, stabilisation_parameter
+
+
+class InitialGuessSolver(object):
+    """ Solves a cheap linear problem on the velocity and pressure spaces,
+    subject to the actual boundary conditions, and writes its solution into
+    `velocity` and `pressure` as the starting point of the iterations.
+
+    'stokes' drops the convective term and solves the Stokes equations with
+    the given viscosity, body forces and velocity / pressure boundary
+    conditions (with PSPG terms if the pair of spaces is `stabilised`).
+
+    'potential' solves a Laplace equation for a velocity potential, with the
+    normal component of the velocity conditions imposed weakly and the
+    potential fixed on the facets with pressure conditions, and takes the
+    velocity as its gradient. The pressure is left as it is.
+    """
+
+    modes = ['stokes', 'potential']
+
+    def __init__(self, velocity_function_space, pressure_function_space,
+                 boundary_conditions, body_forces, viscosity, velocity,
+                 pressure, solver_params='direct', stabilised=False):
+
+        self.V = velocity_function_space
+        self.Q = pressure_function_space
+        self.mesh = self.V.mesh()
+        self.bcs = boundary_conditions
+        self.body_forces = body_forces
+        self.nu = viscosity
+        self.u_n = velocity
+        self.p_n = pressure
+        self.solver_params = solver_params
+        self.stabilised = stabilised
+
+
+    def solve(self, mode):
+        """ Solves the linear problem and overwrites the velocity (and, for
+        'stokes', the pressure) with its solution.
+
+        :param mode: The linear problem -- 'stokes' or 'potential'
+        :type mode: str
+        """
+        if mode == 'stokes':
+            self.solve_stokes()
+        elif mode == 'potential':
+            self.solve_potential()
+        else:
+            raise ValueError("Unknown initial guess '{}' (use one of {})"\
+                             .format(mode, ', '.join(self.modes)))
+
+
+    @profile
+    def solve_stokes(self):
+        """ Solves the Stokes equations on the mixed velocity / pressure space
+        """
+        W = self.V * self.Q
+        u, p = TrialFunctions(W)
+        v, q = TestFunctions(W)
+
+        a = self.nu*inner(grad(u), grad(v))*dx \
+            - p*div(v)*dx \
+            - q*div(u)*dx
+        L = inner(self.body_forces, v)*dx
+        if self.stabilised:
+            tau = stabilisation_parameter(self.mesh, self.nu)
+            a -= tau*inner(grad(p) - self.nu*div(grad(u)), grad(q))*dx
+            L -= tau*inner(self.body_forces, grad(q))*dx
+        bcs = self.bcs.get_dirichlet_bcs('u', W.sub(0)) \
+              + self.bcs.get_dirichlet_bcs('p', W.sub(1))
+
+        if isinstance(self.solver_params, dict):
+            petsc_params = self.solver_params
+        else:
+            petsc_params = solver_presets[self.solver_params]
+        appctx = {'velocity_space': 0,
+                  'Re': 1/self.nu,
+                  'u0': self.u_n}
+
+        up = Function(W)
+        solve(a == L, up, bcs=bcs, solver_parameters=petsc_params,
+              options_prefix='initial_guess_', appctx=appctx)
+        u, p = up.split()
+        self.u_n.assign(u)
+        self.p_n.assign(p)
+
+
+    @profile
+    def solve_potential(self):
+        """ Solves for the velocity potential and sets the velocity to its
+        gradient
+        """
+        Phi = FunctionSpace(self.mesh, 'CG', self.V.ufl_element().degree())
+        phi = TrialFunction(Phi)
+        psi = TestFunction(Phi)
+        n = FacetNormal(self.mesh)
+
+        if not self.bcs.bc_p_list:
+            raise ValueError("A potential flow initial guess needs a pressure "
+                             "condition on at least one facet")
+
+        # The last velocity condition set on a facet takes precedence
+        conditions = OrderedDict()
+        for expression, facet_id, time_dependent in self.bcs.bc_u_list:
+            conditions[facet_id] = expression
+
+        a = inner(grad(phi), grad(psi))*dx
+        L = Constant(0)*psi*dx
+        for facet_id, expression in conditions.items():
+            L += inner(expression, n)*psi*ds(facet_id)
+        facets = tuple(OrderedDict.fromkeys(facet_id for expression, facet_id,
+                                            time_dependent
+                                            in self.bcs.bc_p_list))
+        bc = DirichletBC(Phi, Constant(0), facets)
+
+        potential = Function(Phi, name='potential')
+        solve(a == L, potential, bcs=bc,
+              solver_parameters={'ksp_type': 'cg',
+                                 'pc_type': 'gamg'},
+              options_prefix='initial_guess_')
+        self.u_n.project(grad(potential))
@@ -0,0 +1,140 @@
+"""
+.. module:: spalart_allmaras_solver
+   :synopsis: A module holding the forms, problem and solver for the
+    Spalart-Allmaras turbulence model
+
+"""
+
+import numpy as np
+from firedrake import *
+from ..helpers import *
+
+
+# Each solve is one linearised implicit pseudo-timestep -- a single Newton step
+# -- which is all a segregated update needs
+spalart_allmaras_params = {'snes_type': 'newtonls',
+                           'snes_linesearch_type': 'basic',
+                           'snes_max_it': 1,
+                           'snes_convergence_test': 'skip',
+                           'ksp_type': 'gmres',
+                           'ksp_rtol': 1.0e-6,
+                           'pc_type': 'bjacobi',
+                           'sub_pc_type': 'ilu'}
+
+
+class SpalartAllmarasSolver(object):
+    """ A class holding the forms, problem and solver for the one-equation
+    Spalart-Allmaras model (without the trip term), solved for its working
+    variable `nu_tilde` with the velocity held fixed. The turbulent viscosity
+    is nu_T = nu_tilde fv1.
+
+    The equation is marched in pseudo-time, with streamline-upwind (SUPG)
+    stabilisation of the convective term, so each solve advances `nu_tilde`
+    by one pseudo-timestep of size `timestep`.
+
+    :param function_space: The space of the working variable
+    :type function_space: :class:`firedrake.FunctionSpace`
+    :param wall_distance: The distance to the nearest wall
+    :type wall_distance: :class:`firedrake.Function`
+    :param bcs: The strong conditions on the working variable (zero on the
+        walls, the inflow value on the inlets)
+    :type bcs: list of :class:`firedrake.DirichletBC`
+    """
+
+    # Model constants
+    cb1 = 0.1355
+    cb2 = 0.622
+    sigma = 2./3.
+    kappa = 0.41
+    cw2 = 0.3
+    cw3 = 2.0
+    cv1 = 7.1
+
+    def __init__(self, function_space, nu_tilde, velocity, viscosity,
+                 wall_distance, timestep, bcs, solver_params=None):
+
+        self.T = function_space
+        self.mesh = function_space.mesh()
+        self.nu_tilde = nu_tilde
+        self.nu_tilde_old = Function(self.T, name='nu_tilde_old')
+        self.u_n = velocity
+        self.nu = viscosity
+        self.d = wall_distance
+        self.Dt = timestep
+        self.bcs = bcs
+        if solver_params is None:
+            solver_params = spalart_allmaras_params
+        self.solver_params = solver_params
+
+
+    def get_forms(self):
+        """ Make the (nonlinear) residual of a pseudo-timestep and the
+        expression for the turbulent viscosity
+        """
+        nt = self.nu_tilde
+        w = TestFunction(self.T)
+        u = self.u_n
+        nu = self.nu
+        kappa = self.kappa
+        sigma = self.sigma
+        cw1 = self.cb1/kappa**2 + (1 + self.cb2)/sigma
+        # The wall distance vanishes on the walls
+        d = max_value(self.d, 1.0e-12)
+
+        chi = nt/nu
+        fv1 = chi**3/(chi**3 + self.cv1**3)
+        fv2 = 1 - chi/(1 + chi*fv1)
+        Omega = sqrt(2*inner(skew(grad(u)), skew(grad(u))))
+        S_tilde = max_value(Omega + nt/(kappa**2*d**2)*fv2, 0.3*Omega)
+        r = min_value(nt/(max_value(S_tilde, 1.0e-16)*kappa**2*d**2), 10)
+        g = r + self.cw2*(r**6 - r)
+        fw = g*((1 + self.cw3**6)/(g**6 + self.cw3**6))**(1./6.)
+
+        # Strong residual without the diffusion (whose second derivatives are
+        # not needed by the stabilisation)
+        R = (nt - self.nu_tilde_old)/self.Dt + dot(u, grad(nt)) \
+            - self.cb1*S_tilde*nt + cw1*fw*(nt/d)**2 \
+            - self.cb2/sigma*inner(grad(nt), grad(nt))
+
+        h = CellDiameter(self.mesh)
+        tau = 1/sqrt((2*sqrt(inner(u, u))/h)**2
+                     + 9*(4*(nu + abs(nt))/(sigma*h**2))**2)
+
+        self.F = R*w*dx \
+                 + (nu + nt)/sigma*inner(grad(nt), grad(w))*dx \
+                 + tau*R*dot(u, grad(w))*dx
+        self.turbulent_viscosity = nt*fv1
+
+
+    def get_solvers(self):
+        """ Make the nonlinear variational solver for a pseudo-timestep
+        """
+        self.get_forms()
+        problem = NonlinearVariationalProblem(self.F, self.nu_tilde,
+                                              bcs=self.bcs)
+        self.solver = NonlinearVariationalSolver(problem,
+                                        solver_parameters=self.solver_params,
+                                        options_prefix='spalart_allmaras_')
+
+
+    @profile
+    def solve(self, n_subcycles=1):
+        """ Advances the working variable by `n_subcycles` pseudo-timesteps.
+        It is kept non-negative.
+        """
+        for i in range(n_subcycles):
+            self.nu_tilde_old.assign(self.nu_tilde)
+            self.solver.solve()
+            data = self.nu_tilde.dat.data
+            data[:] = np.maximum(data, 0.)
+            profiler.count('turbulence_ksp_iterations',
+                           self.solver.snes.ksp.getIterationNumber())
+
+
+    def update_turbulent_viscosity(self, nu_T):
+        """ Sets the turbulent viscosity from the working variable
+
+        :param nu_T: The turbulent viscosity
+        :type nu_T: :class:`firedrake.Function`
+        """
+        nu_T.interpolate(self.turbulent_viscosity)
@@ -6,17 +6,207 @@
 """
 
 from firedrake import *
+from firedrake.petsc import PETSc
 from ..helpers import *
 
 
+# Named PETSc configurations for the velocity / pressure system. The Schur
+# complement presets split the Taylor-Hood system into velocity and pressure
+# blocks, solve the velocity block with algebraic multigrid and approximate
+# the Schur complement with either least-squares commutators (LSC) or a
+# pressure convection-diffusion (PCD) operator. The 'schur_gmg' preset uses
+# geometric multigrid on the velocity block instead, which needs a domain with
+# a mesh hierarchy. The 'schur_pcd' and 'schur_pcd_p1' presets are matrix-free:
+# the operator is applied through its kernels and only what the
+# preconditioners need is assembled -- the velocity block, or for
+# 'schur_pcd_p1' only its lowest order (P1) counterpart.
+_schur_base = {'ksp_type': 'fgmres',
+               'ksp_rtol': 1.0e-8,
+               'pc_type': 'fieldsplit',
+               'pc_fieldsplit_type': 'schur',
+               'pc_fieldsplit_schur_fact_type': 'upper'}
+
+solver_presets = {
+    'direct': {'mat_type': 'aij',
+               'ksp_type': 'preonly',
+               'pc_type': 'lu',
+               'pc_factor_mat_solver_type': 'mumps'},
+
+    'schur_lsc': dict(_schur_base, **{
+               'mat_type': 'aij',
+               'pc_fieldsplit_schur_precondition': 'self',
+               'fieldsplit_0_ksp_type': 'preonly',
+               'fieldsplit_0_pc_type': 'gamg',
+               'fieldsplit_1_ksp_type': 'gmres',
+               'fieldsplit_1_ksp_rtol': 1.0e-2,
+               'fieldsplit_1_pc_type': 'lsc',
+               'fieldsplit_1_lsc_pc_type': 'gamg'}),
+
+    'schur_gmg': dict(_schur_base, **{
+               'mat_type': 'aij',
+               'pc_fieldsplit_schur_precondition': 'self',
+               'fieldsplit_0_ksp_type': 'preonly',
+               'fieldsplit_0_pc_type': 'mg',
+               'fieldsplit_0_pc_mg_galerkin': 'both',
+               'fieldsplit_0_mg_levels_ksp_type': 'chebyshev',
+               'fieldsplit_0_mg_levels_ksp_max_it': 2,
+               'fieldsplit_0_mg_levels_pc_type': 'sor',
+               'fieldsplit_1_ksp_type': 'gmres',
+               'fieldsplit_1_ksp_rtol': 1.0e-2,
+               'fieldsplit_1_pc_type': 'lsc',
+               'fieldsplit_1_lsc_pc_type': 'gamg'}),
+
+    'schur_pcd': dict(_schur_base, **{
+               'mat_type': 'matfree',
+               'pc_fieldsplit_schur_fact_type': 'lower',
+               'fieldsplit_0_ksp_type': 'preonly',
+               'fieldsplit_0_pc_type': 'python',
+               'fieldsplit_0_pc_python_type': 'firedrake.AssembledPC',
+               'fieldsplit_0_assembled_pc_type': 'gamg',
+               'fieldsplit_1_ksp_type': 'preonly',
+               'fieldsplit_1_pc_type': 'python',
+               'fieldsplit_1_pc_python_type': 'firedrake.PCDPC',
+               'fieldsplit_1_pcd_Mp_ksp_type': 'preonly',
+               'fieldsplit_1_pcd_Mp_pc_type': 'jacobi',
+               'fieldsplit_1_pcd_Kp_ksp_type': 'preonly',
+               'fieldsplit_1_pcd_Kp_pc_type': 'gamg',
+               'fieldsplit_1_pcd_Fp_mat_type': 'matfree'}),
+
+    'schur_pcd_p1': dict(_schur_base, **{
+               'mat_type': 'matfree',
+               'pc_fieldsplit_schur_fact_type': 'lower',
+               'fieldsplit_0_ksp_type': 'preonly',
+               'fieldsplit_0_pc_type': 'python',
+               'fieldsplit_0_pc_python_type': 'firedrake.P1PC',
+               'fieldsplit_0_pmg_mg_levels_ksp_type': 'chebyshev',
+               'fieldsplit_0_pmg_mg_levels_ksp_max_it': 2,
+               'fieldsplit_0_pmg_mg_levels_pc_type': 'jacobi',
+               'fieldsplit_0_pmg_mg_coarse_mat_type': 'aij',
+               'fieldsplit_0_pmg_mg_coarse_ksp_type': 'preonly',
+               'fieldsplit_0_pmg_mg_coarse_pc_type': 'gamg',
+               'fieldsplit_1_ksp_type': 'preonly',
+               'fieldsplit_1_pc_type': 'python',
+               'fieldsplit_1_pc_python_type': 'firedrake.PCDPC',
+               'fieldsplit_1_pcd_Mp_ksp_type': 'preonly',
+               'fieldsplit_1_pcd_Mp_pc_type': 'jacobi',
+               'fieldsplit_1_pcd_Kp_ksp_type': 'preonly',
+               'fieldsplit_1_pcd_Kp_pc_type': 'gamg',
+               'fieldsplit_1_pcd_Fp_mat_type': 'matfree'}),
+}
+
+
+# Python preconditioners which work on the matrix-free form of the operator
+_matfree_pcs = ['firedrake.PCDPC', 'firedrake.P1PC', 'firedrake.PMGPC']
+
+
+def check_mat_type(petsc_params):
+    """ Raises a ValueError if the preconditioners in PETSc options cannot
+    work with their matrix type: the PCD and P1 preconditioners need a
+    'matfree' operator, and a 'nest' matrix can only be split into its
+    blocks, not factored as a whole.
+
+    :param petsc_params: The PETSc options
+    :type petsc_params: dict
+    """
+    mat_type = petsc_params.get('mat_type', 'aij')
+    if mat_type == 'matfree':
+        return
+    for key, value in sorted(petsc_params.items()):
+        if key.endswith('pc_python_type') and value in _matfree_pcs:
+            raise ValueError("{} ('{}') needs mat_type 'matfree', not '{}'"\
+                             .format(value, key, mat_type))
+    if mat_type == 'nest' and petsc_params.get('pc_type') != 'fieldsplit':
+        raise ValueError("A 'nest' matrix needs a fieldsplit preconditioner, "
+                         "not pc_type '{}'"\
+                         .format(petsc_params.get('pc_type')))
+
+
+def set_mat_type(petsc_params, mat_type):
+    """ Returns a copy of PETSc options switched to another matrix type.
+
+    Going to 'matfree', the operator is applied through its kernels and the
+    assembled preconditioner is kept by wrapping it in
+    :class:`firedrake.AssembledPC`. Going back to an assembled type, such
+    wrappers are removed again. Combinations which cannot work (see
+    :func:`check_mat_type`) raise a ValueError.
+
+    :param petsc_params: The PETSc options
+    :type petsc_params: dict
+    :param mat_type: 'aij', 'nest' or 'matfree'
+    :type mat_type: str
+    """
+    old_mat_type = petsc_params.get('mat_type', 'aij')
+    params = dict(petsc_params, mat_type=mat_type)
+    if (old_mat_type == 'matfree') == (mat_type == 'matfree'):
+        check_mat_type(params)
+        return params
+
+    if mat_type == 'matfree':
+        wrapped = dict((key, value) for key, value in params.items()
+                       if not key.startswith(('pc_', 'fieldsplit_')))
+        wrapped.update(('assembled_' + key, value)
+                       for key, value in params.items()
+                       if key.startswith(('pc_', 'fieldsplit_')))
+        wrapped.update({'pc_type': 'python',
+                        'pc_python_type': 'firedrake.AssembledPC'})
+        return wrapped
+
+    # Unwrap the assembled preconditioners, wherever they are in the tree
+    prefixes = [key[:-len('pc_python_type')] for key, value in params.items()
+                if key.endswith('pc_python_type')
+                and value == 'firedrake.AssembledPC']
+    for prefix in prefixes:
+        del params[prefix + 'pc_type']
+        del params[prefix + 'pc_python_type']
+        for key in [k for k in params if k.startswith(prefix + 'assembled_')]:
+            params[prefix + key[len(prefix + 'assembled_'):]] = params.pop(key)
+    check_mat_type(params)
+    return params
+
+
+def stabilisation_parameter(mesh, viscosity, velocity=None):
+    """ The PSPG / SUPG stabilisation parameter of equal-order elements,
+    tau = ((2|u|/h)^2 + 9(4 nu/h^2)^2)^(-1/2).
+
+    :param velocity: The advecting velocity (None for Stokes flow)
+    :type velocity: :class:`firedrake.Function`
+    """
+    h = CellDiameter(mesh)
+    tau_inverse_squared = 9*(4*viscosity/h**2)**2
+    if velocity is not None:
+        tau_inverse_squared += (2*sqrt(inner(velocity, velocity))/h)**2
+    return 1/sqrt(tau_inverse_squared)
+
+
 class VelocityPressureSolver(object):
     """ A class holding the forms, problem and solver for the velocity /
     pressure equations.
+
+    The equations are linearised about the current velocity (Picard / Oseen)
+    and marched in pseudo-time, so each solve advances the state held in
+    `velocity` and `pressure` by one pseudo-timestep of size `timestep`.
+
+    Each pseudo-timestep is solved in defect-correction form: the operator
+    acts on the update and the right hand side is the steady residual at the
+    current state. The converged solution therefore does not depend on the
+    operator, which can be lagged (kept, along with its preconditioner, over
+    several iterations) without changing the answer.
+
+    The solver can also take steady Newton steps (see :meth:`set_newton`):
+    the pseudo-time mass term is dropped and the operator gains the
+    linearisation of the convective term in the update, so that it is the
+    Jacobian of the steady residual.
+
+    Equal-order velocity / pressure pairs, which do not satisfy the inf-sup
+    condition on their own, are stabilised (`stabilised=True`) with pressure-
+    and streamline-upwind Petrov-Galerkin (PSPG / SUPG) terms.
     """
 
     def __init__(self, domain, velocity_function_space, pressure_function_space,
                  boundary_conditions, body_forces, background_viscosity,
-                 turbulent_viscosity=Constant(0), solver_params='direct'):
+                 velocity, pressure, timestep,
+                 turbulent_viscosity=Constant(0), solver_params='direct',
+                 mat_type=None, stabilised=False):
 
         self.domain = domain
         self.mesh = domain.mesh
@@ -26,21 +216,53 @@ class VelocityPressureSolver(object):
         self.body_forces = body_forces
         self.nu_bg = background_viscosity
         self.nu_T = turbulent_viscosity
+        self.u_n = velocity
+        self.p_n = pressure
+        self.Dt = timestep
         self.solver_params = solver_params
+        self.requested_mat_type = mat_type
+        self.stabilised = stabilised
+        # Weights of the pseudo-time mass term and of the Newton term in the
+        # operator (switched by `set_newton`)
+        self.transient = Constant(1.0)
+        self.newton = Constant(0.0)
+        # A timestep field (local timestepping) changes with the state
+        self.local_timestep = not isinstance(timestep, Constant)
+
+        # Mixed space and the function the update is written into
+        self.W = self.V * self.Q
+        self.dup = Function(self.W, name='dup')
+        self.residual = None
 
 
     def get_solvers(self):
         """ Makes the linear variational solvers for the velocity / pressure
         solve.
+
+        With an assembled operator (any `mat_type` other than 'matfree') the
+        parts of the operator which do not depend on the state are assembled
+        once and cached, and only the state-dependent part is reassembled when
+        the operator is rebuilt.
         """
-        # Get the problem
-        self.get_problems()
         # Get the solver parameters
         self.get_petsc_params()
-        # Define the solver
-        self.solver = LinearVariationalSolver(self.problem,
-                                            solver_parameters=self.petsc_params,
-                                            options_prefix='TODO_')
+        self.mat_type = self.petsc_params.get('mat_type', 'aij')
+        if self.mat_type == 'matfree':
+            # Get the problem
+            self.get_problems()
+            # Define the solver
+            self.solver = LinearVariationalSolver(
+                              self.problem,
+                              solver_parameters=self.petsc_params,
+                              options_prefix='velocity_pressure_',
+                              appctx=self.get_appctx())
+        else:
+            self.get_forms()
+            self.get_bcs()
+            self.constant_operators = None
+            self.A = None
+            self.b = Cofunction(self.W.dual())
+            self.solver = None
 
 
     def get_problems(self):
@@ -49,17 +271,245 @@ class VelocityPressureSolver(object):
         """
         # Get the variational forms of the equations
         self.get_forms()
+        # Get the strong boundary conditions on the mixed space
+        self.get_bcs()
         # Define the problem
-        self.problem = LinearVariationalProblem(lhs_a, rhs_L, soln_placeholder,
-                                                constant_jacobian=False)
+        self.problem = LinearVariationalProblem(self.a, self.L, self.dup,
+                                                bcs=self.bc_list,
+                                                constant_jacobian=True)
 
 
     def get_forms(self):
         """ Make the variational forms for the velocity / pressure solve.
+
+        The operator is split into the mass term (scaled by the pseudo-timestep
+        when the operator is put together), the terms which do not change
+        between iterations (background viscosity, pressure gradient and
+        divergence) and the state-dependent terms (convection and turbulent
+        viscosity). With local timestepping the timestep is a field which
+        changes with the state, so the mass term joins the state-dependent
+        terms. The Newton term is state-dependent too.
+        """
+        u, p = TrialFunctions(self.W)
+        v, q = TestFunctions(self.W)
+        u_n = self.u_n
+        p_n = self.p_n
+        nu = self.nu_bg + self.nu_T
+
+        # Steady residual evaluated at the current state
+        self.F_steady = inner(dot(grad(u_n), u_n), v)*dx \
+                        + nu*inner(grad(u_n), grad(v))*dx \
+                        - p_n*div(v)*dx \
+                        - q*div(u_n)*dx \
+                        - inner(self.body_forces, v)*dx
+
+        # Pseudo-timestep of the Oseen linearisation, acting on the update
+        self.a_mass = inner(u, v)*dx
+        self.a_constant = self.nu_bg*inner(grad(u), grad(v))*dx \
+                          - p*div(v)*dx \
+                          - q*div(u)*dx
+        self.a_nonlinear = inner(dot(grad(u), u_n), v)*dx \
+                           + self.nu_T*inner(grad(u), grad(v))*dx \
+                           + self.newton*inner(dot(grad(u_n), u), v)*dx
+        if self.local_timestep:
+            self.a_nonlinear += self.transient*inner(u, v)/self.Dt*dx
+            self.a = self.a_constant + self.a_nonlinear
+        else:
+            self.a = (self.transient/self.Dt)*self.a_mass + self.a_constant \
+                     + self.a_nonlinear
+
+        if self.stabilised:
+            # Residual-based PSPG / SUPG terms, weighted by the strong
+            # momentum residual (linearised about u_n for the operator)
+            tau = stabilisation_parameter(self.mesh, nu, u_n)
+            R_steady = dot(grad(u_n), u_n) - nu*div(grad(u_n)) + grad(p_n) \
+                       - self.body_forces
+            R = self.transient*u/self.Dt + dot(grad(u), u_n) \
+                - nu*div(grad(u)) + grad(p)
+            weight = tau*(dot(grad(v), u_n) - grad(q))
+            self.F_steady += inner(R_steady, weight)*dx
+            self.a_nonlinear += inner(R, weight)*dx
+            self.a += inner(R, weight)*dx
+        self.L = -self.F_steady
+
+
+    def get_bcs(self):
+        """ Make the strong boundary conditions on the mixed space. The state
+        already satisfies the boundary conditions, so the update is subject to
+        their homogeneous counterparts.
         """
-        pass
+        self.bc_list = \
+            self.bcs.get_dirichlet_bcs('u', self.W.sub(0), homogeneous=True) \
+            + self.bcs.get_dirichlet_bcs('p', self.W.sub(1), homogeneous=True)
+
 
     def get_petsc_params(self):
+        """ Turns the `solver_params` option into a PETSc options dictionary.
+
+        `solver_params` is either the name of one of the `solver_presets` or a
+        dictionary of PETSc options. A `mat_type` given to the solver overrides
+        the one in the options (see :func:`set_mat_type`).
+        """
+        if isinstance(self.solver_params, dict):
+            self.petsc_params = self.solver_params
+        elif self.solver_params in solver_presets:
+            self.petsc_params = dict(solver_presets[self.solver_params])
+        else:
+            raise ValueError("Unknown solver parameters: {}. Choose from {}"\
+                             .format(self.solver_params,
+                                     sorted(solver_presets.keys())))
+        if self.requested_mat_type is not None:
+            self.petsc_params = set_mat_type(self.petsc_params,
+                                             self.requested_mat_type)
+        check_mat_type(self.petsc_params)
+
+
+    def get_appctx(self):
+        """ The application context needed by the Python preconditioners
+        (the PCD approximation uses the Reynolds number and the advecting
+        velocity, the pressure mass matrix approximation the viscosity).
+        """
+        return {'velocity_space': 0,
+                'Re': 1.0/(self.nu_bg + self.nu_T),
+                'mu': self.nu_bg + self.nu_T,
+                'u0': self.u_n}
+
+
+    def assemble_constant_operators(self):
+        """ Assembles and caches the mass matrix and the state-independent part
+        of the operator.
+        """
+        # A field of local timesteps puts the mass term in with the
+        # state-dependent terms, so no mass matrix is kept
+        forms = [self.a_constant] if self.local_timestep \
+                else [self.a_constant, self.a_mass]
+        self.constant_operators = \
+            [assemble(form, bcs=self.bc_list, mat_type=self.mat_type)
+             for form in forms]
+
+
+    def invalidate_constant_operators(self):
+        """ Forces the cached state-independent operators to be reassembled
+        next time the operator is rebuilt -- e.g. after the background
+        viscosity has been changed.
+        """
+        if self.mat_type != 'matfree':
+            self.constant_operators = None
+
+
+    @profile
+    def assemble_operator(self):
+        """ Reassembles the state-dependent part of the operator and adds the
+        cached parts to it.
+
+        All parts are assembled with the (homogeneous) boundary conditions, so
+        the boundary rows and columns are zero apart from a positive diagonal,
+        which leaves the zero update on the boundary unchanged.
+        """
+        if self.constant_operators is None:
+            self.assemble_constant_operators()
+        K = self.constant_operators[0]
+
+        # The state-dependent part only couples the velocities, so the matrix
+        # is allocated once from the full operator, whose sparsity holds the
+        # cached parts as well
+        if self.A is None:
+            self.A = assemble(self.a, bcs=self.bc_list,
+                              mat_type=self.mat_type)
+        self.A = assemble(self.a_nonlinear, tensor=self.A,
+                          bcs=self.bc_list, mat_type=self.mat_type)
+        A = self.A.petscmat
+        structure = PETSc.Mat.Structure.SUBSET_NONZERO_PATTERN
+        A.axpy(1.0, K.petscmat, structure=structure)
+        mass_scale = float(self.transient)
+        if mass_scale and not self.local_timestep:
+            M = self.constant_operators[1]
+            A.axpy(mass_scale/float(self.Dt), M.petscmat, structure=structure)
+
+        if self.solver is None:
+            self.solver = LinearSolver(self.A,
+                                       solver_parameters=self.petsc_params,
+                                       options_prefix='velocity_pressure_',
+                                       appctx=self.get_appctx())
+
+
+    def solve(self, rebuild_operator=True):
+        """ Advances the velocity and pressure by one pseudo-timestep.
+
+        :param rebuild_operator: Reassemble the operator and set up the
+            preconditioner again, rather than reusing those from the last solve
+        :type rebuild_operator: bool
+        """
+        if self.mat_type == 'matfree':
+            if rebuild_operator:
+                self.solver.invalidate_jacobian()
+            with profiler.stage('linear_solve'):
+                self.solver.solve()
+            ksp = self.solver.snes.ksp
+        else:
+            if rebuild_operator or self.A is None:
+                self.assemble_operator()
+            with profiler.stage('assemble_rhs'):
+                assemble(self.L, tensor=self.b)
+            with profiler.stage('linear_solve'):
+                self.solver.solve(self.dup, self.b)
+            ksp = self.solver.ksp
+        profiler.count('ksp_iterations', ksp.getIterationNumber())
+        du, dp = self.dup.split()
+        self.u_n += du
+        self.p_n += dp
+
+
+    def set_newton(self, newton):
+        """ Switches between pseudo-timesteps of the Oseen linearisation and
+        steady Newton steps. The operator has to be rebuilt before the next
+        solve.
+
+        :param newton: Whether to take Newton steps
+        :type newton: bool
         """
+        self.newton.assign(1.0 if newton else 0.0)
+        self.transient.assign(0.0 if newton else 1.0)
+
+
+    @profile
+    def line_search(self, residual_0, max_backtracks=8,
+                    sufficient_decrease=1e-4):
+        """ Backtracks along the last update until the steady residual has
+        dropped sufficiently below `residual_0` (the residual before the
+        update), halving the step each time. Returns the step length taken.
+
+        :param residual_0: The norm of the residual before the update
+        :type residual_0: float
+        :param max_backtracks: The most times the step is halved
+        :type max_backtracks: int
+        """
+        du, dp = self.dup.split()
+        alpha = 1.0
+        for i in range(max_backtracks):
+            target = (1 - sufficient_decrease*alpha)*residual_0
+            if self.get_residual() <= target:
+                break
+            alpha *= 0.5
+            self.u_n.assign(self.u_n - alpha*du)
+            self.p_n.assign(self.p_n - alpha*dp)
+        return alpha
+
+
+    @profile
+    def assemble_residual(self):
+        """ Returns the steady residual at the current state, with the
+        strongly imposed degrees of freedom zeroed.
+        """
+        self.residual = assemble(self.F_steady, tensor=self.residual)
+        for bc in self.bc_list:
+            bc.zero(self.residual)
+        return self.residual
+
+
+    def get_residual(self):
+        """ Returns the l2 norm of the steady residual at the current state,
+        excluding the strongly imposed degrees of freedom.
         """
-        pass
+        with self.assemble_residual().dat.vec_ro as r:
+            return r.norm()
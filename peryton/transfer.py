@@ -0,0 +1,98 @@
+"""
+.. module:: transfer
+   :synopsis: Transfers fields from a checkpointed solution on another mesh
+
+"""
+
+import numpy as np
+from firedrake import *
+from .helpers import *
+
+
+class SolutionTransfer(object):
+    """ Interpolates the fields of a checkpoint file onto the function spaces
+    of another mesh -- e.g. to start a run on a refined mesh or a modified
+    geometry from an earlier solution.
+
+    The nodes of the target space are located in the source mesh with a
+    :class:`firedrake.VertexOnlyMesh`, which searches a bounding-box tree over
+    the source cells and works in parallel (each process locates the nodes it
+    owns, wherever their source cells are). The located points are cached per
+    target element, so fields sharing a space share the search. Target nodes
+    outside the source mesh keep the value they had before the transfer.
+
+    :param checkpoint_file: The .h5 checkpoint file holding the source mesh and
+        fields
+    :type checkpoint_file: str
+    :param tolerance: How far (relative to the cell size) outside a source
+        cell a node can be and still be located in it (None for the firedrake
+        default)
+    :type tolerance: float
+    """
+
+    def __init__(self, checkpoint_file, tolerance=None, comm=COMM_WORLD):
+
+        self.checkpoint_file = checkpoint_file
+        self.tolerance = tolerance
+        self.comm = comm
+        with CheckpointFile(checkpoint_file, 'r', comm=comm) as f:
+            self.mesh = f.load_mesh()
+        self.vertex_only_meshes = {}
+
+
+    def get_vertex_only_mesh(self, function_space):
+        """ Returns the points of the source mesh at the nodes of a target
+        space (located on first use)
+        """
+        element = function_space.ufl_element()
+        key = (function_space.mesh(), element.family(), element.degree())
+        if key not in self.vertex_only_meshes:
+            mesh = function_space.mesh()
+            X = VectorFunctionSpace(mesh, element.family(), element.degree())
+            nodes = Function(X).interpolate(SpatialCoordinate(mesh))
+            self.vertex_only_meshes[key] = VertexOnlyMesh(
+                self.mesh, nodes.dat.data_ro, redundant=False,
+                missing_points_behaviour='warn', tolerance=self.tolerance)
+        return self.vertex_only_meshes[key]
+
+
+    @profile
+    def transfer(self, target, name=None):
+        """ Interpolates a checkpointed field onto a target function.
+
+        :param target: The function to write the field into
+        :type target: :class:`firedrake.Function`
+        :param name: The name of the field in the checkpoint (defaults to the
+            name of the target)
+        :type name: str
+        """
+        if name is None:
+            name = target.name()
+        with CheckpointFile(self.checkpoint_file, 'r', comm=self.comm) as f:
+            source = f.load_function(self.mesh, name)
+
+        vom = self.get_vertex_only_mesh(target.function_space())
+        shape = target.ufl_shape
+        if shape:
+            P0 = VectorFunctionSpace(vom, 'DG', 0, dim=shape[0])
+            P0_input = VectorFunctionSpace(vom.input_ordering, 'DG', 0,
+                                           dim=shape[0])
+        else:
+            P0 = FunctionSpace(vom, 'DG', 0)
+            P0_input = FunctionSpace(vom.input_ordering, 'DG', 0)
+
+        # Evaluate at the located points, then return the values to the
+        # processes (and order) the nodes were given in
+        values = Function(P0).interpolate(source)
+        values = Function(P0_input).interpolate(values)
+        located = Function(FunctionSpace(vom.input_ordering, 'DG', 0))
+        located.interpolate(Function(FunctionSpace(vom, 'DG', 0)).assign(1))
+
+        found = located.dat.data_ro > 0.5
+        data = target.dat.data
+        data[found] = values.dat.data_ro[found]
+        n_missing = self.comm.allreduce(int(np.sum(~found)))
+        if n_missing:
+            info_out('{} nodes of {} are outside the mesh of {} and keep '
+                     'their initial values'.format(n_missing, name,
+                                                   self.checkpoint_file))
@@ -0,0 +1,140 @@
+"""
+.. benchmark:: cases
+   :synopsis: The benchmark cases -- the laminar diffusor of
+    tests/human_tests/01_laminar_diffusor.py and a three dimensional channel
+    -- parameterised by resolution
+
+Runs one case and writes its measurements to a .json file. Run under MPI
+with e.g.
+
+    mpiexec -n 4 python cases.py --case diffusor --resolution 0.05 \
+        --result result.json
+
+"""
+
+import argparse
+import json
+import time
+
+start_time = time.time()
+
+from peryton import *
+from scipy.special import erf
+
+
+def diffusor_domain(resolution, comm=COMM_WORLD):
+    """ The two dimensional diffusor (Lx = 16, Ly = 1) with an erf-shaped
+    expansion
+    """
+    Lx = 16
+    Ly = 1
+    def dy(x, N=6.):
+        return (erf(x - Lx/2.) + N)/(N - 1.)
+    Nx = int(Lx * (1./resolution))
+    Ny = int(Ly * (1./resolution))
+    mesh = RectangleMesh(Nx, Ny, Lx, Ly, comm=comm)
+    x = mesh.coordinates.dat.data
+    x[:, 1] = x[:, 1] * dy(x[:, 0])
+
+    domain = SimpleDomain(mesh)
+    domain.label_facet(1, 'Inflow', inlet=True)
+    domain.label_facet(2, 'Outlet', outlet=True)
+    domain.label_facet(3, 'Straight side wall', wall=True)
+    domain.label_facet(4, 'Diffusor wall', wall=True)
+    return domain
+
+
+def channel_domain(resolution, comm=COMM_WORLD):
+    """ A three dimensional square channel (Lx = 4, Ly = Lz = 1)
+    """
+    Lx = 4
+    N = int(1./resolution)
+    mesh = BoxMesh(Lx*N, N, N, Lx, 1, 1, comm=comm)
+
+    domain = SimpleDomain(mesh)
+    domain.label_facet(1, 'Inflow', inlet=True)
+    domain.label_facet(2, 'Outlet', outlet=True)
+    domain.label_facet([3, 4, 5, 6], 'Channel wall', wall=True)
+    return domain
+
+
+cases = {'diffusor': diffusor_domain,
+         'channel': channel_domain}
+
+
+def run_case(case, resolution, reynolds_number=100., max_iterations=50,
+             solver_params='direct'):
+    """ Runs a case and returns its measurements
+    """
+    domain = cases[case](resolution)
+    n_dims = domain.n_dims
+
+    problem_parameters = Problem.default_parameters()
+    problem_parameters.domain = domain
+    nu = 1.81e-5
+    u_in = reynolds_number * nu / 1.
+
+    zero = Constant((0,)*n_dims)
+    inflow = Constant((u_in,) + (0,)*(n_dims - 1))
+    bcs = NS_BoundaryConditions()
+    bcs.add_bc_p(Constant(0), domain.outlet_list)
+    bcs.add_bc_u(inflow, domain.inlet_list)
+    bcs.add_bc_u(zero, domain.wall_list)
+    problem_parameters.bcs = bcs
+
+    ics = NS_InitialConditions()
+    ics.set_ic_u(zero)
+    ics.set_ic_p(Constant(0))
+    problem_parameters.ics = ics
+
+    problem_parameters.nu = nu
+    problem_parameters.max_iterations = max_iterations
+    problem_parameters.dt = 1
+    problem = Problem(problem_parameters)
+
+    algorithm_parameters = NS_Algorithm.default_parameters()
+    algorithm_parameters.solver_params = solver_params
+    algorithm = NS_Algorithm(algorithm_parameters, problem)
+
+    comm = domain.mesh.comm
+    comm.barrier()
+    setup_time = time.time() - start_time
+
+    run_start = time.time()
+    algorithm.run()
+    comm.barrier()
+    run_time = time.time() - run_start
+
+    report = profiler.report(comm)
+    return {'case': case,
+            'resolution': resolution,
+            'n_processes': comm.size,
+            'n_cells': comm.allreduce(domain.mesh.cell_set.size),
+            'n_dofs': algorithm.V.dim() + algorithm.Q.dim(),
+            'setup_time': setup_time,
+            'time_per_iteration': run_time/max(algorithm.it_no, 1),
+            'iterations': algorithm.it_no,
+            'converged': algorithm.converged,
+            'peak_rss_mb': report['peak_rss_mb']['max']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--case', choices=sorted(cases.keys()),
+                        default='diffusor')
+    parser.add_argument('--resolution', type=float, default=0.05)
+    parser.add_argument('--max-iterations', type=int, default=50)
+    parser.add_argument('--solver-params', default='direct')
+    parser.add_argument('--result', default='result.json')
+    args = parser.parse_args()
+
+    result = run_case(args.case, args.resolution,
+                      max_iterations=args.max_iterations,
+                      solver_params=args.solver_params)
+    if COMM_WORLD.rank == 0:
+        with open(args.result, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
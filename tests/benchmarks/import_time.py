@@ -0,0 +1,67 @@
+"""
+.. benchmark:: import_time
+   :synopsis: Measures the time taken to import Peryton against a budget
+
+Each measurement is the fastest of several runs of a fresh interpreter, less
+the start up time of the interpreter itself. Run with
+
+    python import_time.py [--repeats N]
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Budgets in seconds. `import peryton` is lazy and should not load firedrake;
+# loading the whole package is dominated by importing firedrake.
+IMPORT_BUDGET = 0.05
+FULL_LOAD_BUDGET = 30.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__))))
+
+
+def time_statement(statement, repeats):
+    """ Returns the fastest wall time of running the statement in a fresh
+    interpreter
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement], env=env)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = time_statement('pass', args.repeats)
+    results = [('import peryton',
+                time_statement('import peryton', args.repeats) - baseline,
+                IMPORT_BUDGET),
+               ('from peryton import *',
+                time_statement('from peryton import *', args.repeats) \
+                - baseline,
+                FULL_LOAD_BUDGET)]
+
+    failed = False
+    for statement, elapsed, budget in results:
+        status = 'ok'
+        if elapsed > budget:
+            status = 'OVER BUDGET'
+            failed = True
+        print('{:<25} {:8.3f} s (budget {:.3f} s) {}'\
+              .format(statement, elapsed, budget, status))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
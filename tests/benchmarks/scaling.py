@@ -0,0 +1,148 @@
+"""
+.. benchmark:: scaling
+   :synopsis: Strong and weak scaling of the benchmark cases, checked against
+    a stored baseline
+
+For each number of processes the case in cases.py is run twice under MPI:
+at the given resolution (strong scaling) and with the resolution refined so
+the number of cells per process stays that of the single process run (weak
+scaling). The measurements are written to <case>_strong.csv and
+<case>_weak.csv, and compared with those in baseline.json. Any measurement
+more than the tolerance worse than its baseline is flagged and the script
+exits with a non-zero code. Run with e.g.
+
+    python scaling.py --case diffusor --resolution 0.05 --processes 1 2 4 8
+
+and add --update-baseline to store the measurements as the new baseline.
+
+"""
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Measurements compared with the baseline (a higher value is worse)
+MEASUREMENTS = ['setup_time', 'time_per_iteration', 'iterations',
+                'peak_rss_mb']
+COLUMNS = ['n_processes', 'resolution', 'n_cells', 'n_dofs', 'converged'] \
+          + MEASUREMENTS
+
+# Spatial dimension of each case, for refining the weak scaling runs
+DIMENSIONS = {'diffusor': 2, 'channel': 3}
+
+
+def run(case, resolution, n_processes, args):
+    """ Runs the case under MPI and returns its measurements
+    """
+    handle, result_file = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    command = [args.mpiexec, '-n', str(n_processes), sys.executable,
+               os.path.join(HERE, 'cases.py'),
+               '--case', case,
+               '--resolution', repr(resolution),
+               '--max-iterations', str(args.max_iterations),
+               '--solver-params', args.solver_params,
+               '--result', result_file]
+    subprocess.check_call(command)
+    with open(result_file) as f:
+        result = json.load(f)
+    os.remove(result_file)
+    return result
+
+
+def write_curve(filename, results):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+
+def key(case, mode, result):
+    return '{}/{}/np{}/res{:g}'.format(case, mode, result['n_processes'],
+                                       result['resolution'])
+
+
+def compare(measured, baseline, tolerance):
+    """ Returns a list of the regressions against the baseline
+    """
+    regressions = []
+    for name, result in sorted(measured.items()):
+        if name not in baseline:
+            continue
+        for measurement in MEASUREMENTS:
+            old = baseline[name][measurement]
+            new = result[measurement]
+            if old > 0 and new > old*(1. + tolerance):
+                regressions.append('{} {}: {:.4g} (baseline {:.4g}, +{:.0f}%)'\
+                                   .format(name, measurement, new, old,
+                                           100.*(new/old - 1.)))
+        if baseline[name]['converged'] and not result['converged']:
+            regressions.append('{}: no longer converges'.format(name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--case', choices=sorted(DIMENSIONS.keys()),
+                        default='diffusor')
+    parser.add_argument('--resolution', type=float, default=0.05)
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--max-iterations', type=int, default=50)
+    parser.add_argument('--solver-params', default='direct')
+    parser.add_argument('--mpiexec', default='mpiexec')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed fractional increase over the baseline')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    dim = DIMENSIONS[args.case]
+    measured = {}
+    curves = {'strong': [], 'weak': []}
+    for n_processes in args.processes:
+        weak_resolution = args.resolution/n_processes**(1./dim)
+        for mode, resolution in [('strong', args.resolution),
+                                 ('weak', weak_resolution)]:
+            result = run(args.case, resolution, n_processes, args)
+            curves[mode].append(result)
+            measured[key(args.case, mode, result)] = result
+
+    for mode, results in curves.items():
+        filename = os.path.join(args.output_dir,
+                                '{}_{}.csv'.format(args.case, mode))
+        write_curve(filename, results)
+        print('Wrote {} scaling to {}'.format(mode, filename))
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update(measured)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Updated {}'.format(BASELINE))
+        return
+
+    missing = [name for name in measured if name not in baseline]
+    if missing:
+        print('No baseline for: ' + ', '.join(sorted(missing)))
+    regressions = compare(measured, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
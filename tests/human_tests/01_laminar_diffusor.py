@@ -45,8 +45,8 @@ problem_parameters.bcs = bcs
 
 # Initial conditions
 ics = NS_InitialConditions()
-ics.set_ic_u = Constant((0, 0))
-ics.set_ic_p = Constant(0)
+ics.set_ic_u(Constant((0, 0)))
+ics.set_ic_p(Constant(0))
 problem_parameters.ics = ics
 
 # Finish setting up the problem
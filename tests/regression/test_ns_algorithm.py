@@ -0,0 +1,65 @@
+"""
+.. test:: test_ns_algorithm
+   :synopsis: A few iterations of a small channel flow with the default
+    ('direct') solver, writing a checkpoint and restarting from it
+
+"""
+
+import os
+import numpy as np
+from peryton import *
+
+
+def make_problem(domain, max_iterations):
+    domain.label_facet(1, 'Inflow', inlet=True)
+    domain.label_facet(2, 'Outlet', outlet=True)
+    domain.label_facet([3, 4], 'Walls', wall=True)
+
+    bcs = NS_BoundaryConditions()
+    bcs.add_bc_p(Constant(0), 2)
+    bcs.add_bc_u(Constant((1, 0)), 1)
+    bcs.add_bc_u(Constant((0, 0)), [3, 4])
+    ics = NS_InitialConditions()
+    ics.set_ic_u(Constant((0, 0)))
+    ics.set_ic_p(Constant(0))
+
+    parameters = Problem.default_parameters()
+    parameters.domain = domain
+    parameters.bcs = bcs
+    parameters.ics = ics
+    parameters.nu = 0.1
+    parameters.dt = 1
+    parameters.max_iterations = max_iterations
+    return Problem(parameters)
+
+
+def make_algorithm(problem, output_dir, restart_file=None):
+    parameters = NS_Algorithm.default_parameters()
+    parameters.output_dir = output_dir
+    parameters.checkpoint_frequency = 2
+    parameters.restart_file = restart_file
+    return NS_Algorithm(parameters, problem)
+
+
+def test_iterations_checkpoint_and_restart(tmpdir):
+    output_dir = str(tmpdir)
+    domain = SimpleDomain(RectangleMesh(12, 4, 3, 1))
+    algorithm = make_algorithm(make_problem(domain, 3), output_dir)
+    algorithm.run()
+    residuals = algorithm.monitor.residuals
+    assert algorithm.it_no == 3
+    assert np.all(np.isfinite(residuals))
+    assert residuals[-1] < residuals[0]
+    history = np.loadtxt(os.path.join(output_dir, 'history.csv'),
+                         delimiter=',', skiprows=1, ndmin=2)
+    assert len(history) == 4
+
+    # Carry on from the checkpoint, on the mesh stored in it
+    checkpoint = os.path.join(output_dir, 'checkpoint.h5')
+    domain = CheckpointDomain(checkpoint)
+    assert domain.wall_list == [3, 4]
+    restarted = make_algorithm(make_problem(domain, 4), output_dir,
+                               restart_file=checkpoint)
+    restarted.run()
+    assert restarted.it_no == 4
+    assert restarted.monitor.residuals[0] < residuals[0]
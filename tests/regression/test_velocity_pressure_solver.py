@@ -0,0 +1,50 @@
+"""
+.. test:: test_velocity_pressure_solver
+   :synopsis: Pseudo-timesteps of the velocity / pressure solver on a small
+    lid driven cavity, with the cached and the matrix-free operator
+
+"""
+
+import numpy as np
+from firedrake import *
+from peryton.domain import SimpleDomain
+from peryton.boundary_conditions import NS_BoundaryConditions
+from peryton.solvers.velocity_pressure_solver import VelocityPressureSolver
+
+
+def make_solver(mat_type=None):
+    domain = SimpleDomain(UnitSquareMesh(6, 6))
+    V = VectorFunctionSpace(domain.mesh, 'CG', 2)
+    Q = FunctionSpace(domain.mesh, 'CG', 1)
+    bcs = NS_BoundaryConditions()
+    bcs.add_bc_u(Constant((1, 0)), 4)
+    bcs.add_bc_u(Constant((0, 0)), [1, 2, 3])
+    bcs.add_bc_p(Constant(0), 1)
+    u = Function(V)
+    p = Function(Q)
+    for bc in bcs.get_dirichlet_bcs('u', V):
+        bc.apply(u)
+    solver = VelocityPressureSolver(domain, V, Q, bcs, Constant((0, 0)),
+                                    Constant(0.1), u, p, Constant(10.),
+                                    solver_params='direct', mat_type=mat_type)
+    solver.get_solvers()
+    return solver
+
+
+def test_pseudo_timesteps_reduce_the_residual():
+    solver = make_solver()
+    residuals = [solver.get_residual()]
+    for rebuild_operator in [True, False, True]:
+        solver.solve(rebuild_operator=rebuild_operator)
+        residuals.append(solver.get_residual())
+    assert all(np.isfinite(residuals))
+    assert residuals[-1] < 0.1*residuals[0]
+
+
+def test_cached_operator_matches_the_full_form():
+    assembled = make_solver()
+    matfree = make_solver(mat_type='matfree')
+    for solver in [assembled, matfree]:
+        solver.solve()
+    assert np.allclose(assembled.u_n.dat.data_ro, matfree.u_n.dat.data_ro)
+    assert np.allclose(assembled.p_n.dat.data_ro, matfree.p_n.dat.data_ro)
@@ -0,0 +1,45 @@
+"""
+.. test:: test_wall_distance
+   :synopsis: Storing and reloading the wall distance as the wall list changes
+
+"""
+
+import os
+from firedrake import *
+from peryton.domain import SimpleDomain, CheckpointDomain
+
+
+def integral(function):
+    return assemble(function*dx)
+
+
+def save(domain, filename, mode):
+    with CheckpointFile(filename, mode) as f:
+        if mode == 'w':
+            f.save_mesh(domain.mesh)
+            domain.save_metadata(f)
+        domain.save_wall_distance(f)
+
+
+def test_wall_distance_follows_the_wall_list(tmpdir):
+    filename = os.path.join(str(tmpdir), 'domain.h5')
+    domain = SimpleDomain(UnitSquareMesh(8, 8))
+    domain.label_facet(1, 'Left', wall=True)
+    one_wall = integral(domain.wall_distance())
+    save(domain, filename, 'w')
+
+    # A second wall is added and then taken away again
+    domain.label_facet(2, 'Right', wall=True)
+    two_walls = integral(domain.wall_distance())
+    assert two_walls < one_wall
+    save(domain, filename, 'a')
+    domain.wall_list = [1]
+    assert abs(integral(domain.wall_distance()) - one_wall) < 1.0e-10
+    save(domain, filename, 'a')
+
+    # Both distances are read back from the file
+    loaded = CheckpointDomain(filename)
+    assert loaded.wall_list == [1]
+    assert abs(integral(loaded.wall_distance()) - one_wall) < 1.0e-10
+    loaded.wall_list = [2, 1]
+    assert abs(integral(loaded.wall_distance()) - two_walls) < 1.0e-10
@@ -0,0 +1,39 @@
+"""
+.. test:: test_algorithm
+   :synopsis: The switched evolution relaxation (SER) timestep
+
+"""
+
+from types import SimpleNamespace
+from peryton.navier_stokes.algorithm_ns import NS_Algorithm
+
+
+def make_state(residual, dt, dt_min=0.1, dt_growth_limit=2.0, dt_max=100.):
+    params = NS_Algorithm.default_parameters()
+    params.dt_growth_limit = dt_growth_limit
+    params.dt_max = dt_max
+    problem = SimpleNamespace(params=SimpleNamespace(dt=dt_min))
+    return SimpleNamespace(residual=residual, dt=dt, params=params,
+                           problem=problem)
+
+
+def ser_timestep(state, residual_nminus1):
+    return NS_Algorithm.get_ser_timestep(state, residual_nminus1)
+
+
+def test_timestep_scales_with_the_residual_reduction():
+    assert abs(ser_timestep(make_state(0.8, 1.0), 1.0) - 1.25) < 1.0e-12
+
+
+def test_growth_is_limited():
+    assert ser_timestep(make_state(0.01, 1.0), 1.0) == 2.0
+    assert ser_timestep(make_state(0., 1.0), 1.0) == 2.0
+
+
+def test_timestep_is_capped():
+    assert ser_timestep(make_state(0.5, 80.), 1.0) == 100.
+
+
+def test_timestep_does_not_drop_below_the_problem_timestep():
+    assert abs(ser_timestep(make_state(2.0, 1.0), 1.0) - 0.5) < 1.0e-12
+    assert ser_timestep(make_state(100.0, 1.0), 1.0) == 0.1
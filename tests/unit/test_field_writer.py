@@ -0,0 +1,48 @@
+"""
+.. test:: test_field_writer
+   :synopsis: Errors in the background worker of the field writer
+
+"""
+
+import queue
+import threading
+import pytest
+from peryton.generic_backend import AsyncFieldWriter
+
+
+class FailingWriter(AsyncFieldWriter):
+    """ A writer without fields, whose writes fail
+    """
+
+    def __init__(self, queue_size):
+        self.functions = []
+        self.buffers = []
+        self.cell_nodes = []
+        self.filename = 'output.pvd'
+        self.index = 0
+        self.times = []
+        self.synchronous = False
+        self.worker_error = None
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.worker = threading.Thread(target=self._work)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _write(self, index, times, arrays):
+        raise IOError('disk full')
+
+
+def test_worker_errors_are_raised_on_the_calling_thread():
+    writer = FailingWriter(queue_size=1)
+    writer.write(0.)
+    writer.pending.join()
+    with pytest.raises(RuntimeError) as error:
+        writer.write(1.)
+    assert isinstance(error.value.__cause__, IOError)
+
+    # The worker still empties the queue
+    for i in range(3):
+        writer.pending.put((i, [], []))
+    with pytest.raises(RuntimeError):
+        writer.close()
+    assert not writer.worker.is_alive()
@@ -0,0 +1,157 @@
+"""
+.. test:: test_monitor
+   :synopsis: The residual norms, chunked .csv history and stopping criteria
+    of the convergence monitor
+
+"""
+
+import os
+from types import SimpleNamespace
+import numpy as np
+from mpi4py import MPI
+from peryton.monitor import CSVHistory, ConvergenceMonitor, \
+                            ToleranceCriterion, StagnationCriterion, \
+                            DivergenceCriterion
+
+
+def make_fields(momentum, continuity, velocity_update, pressure_update):
+    """ Stand-ins for the residual and the velocity and pressure at two
+    iterations, holding only their data
+    """
+    def data(values):
+        return SimpleNamespace(data_ro=np.array(values, dtype=float))
+
+    def pair(update):
+        return (SimpleNamespace(dat=data(update)),
+                SimpleNamespace(dat=data(np.zeros(len(update)))))
+
+    residual = SimpleNamespace(dat=[data(momentum), data(continuity)])
+    return residual, pair(velocity_update), pair(pressure_update)
+
+
+def read_rows(filename):
+    with open(filename) as f:
+        header = f.readline().strip().split(',')
+    rows = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+    return header, rows
+
+
+def test_update_combines_the_norms():
+    monitor = ConvergenceMonitor(MPI.COMM_SELF)
+    fields = make_fields([3.], [4.], [1., 2., 2.], [2.])
+    assert monitor.update(0, 0., 1., *fields) == 5.
+    assert monitor.residual_0 == 5.
+    fields = make_fields([0.], [1.], [0.], [0.])
+    assert monitor.update(1, 1., 1., *fields) == 1.
+    assert monitor.residual_0 == 5.
+    assert monitor.residuals == [5., 1.]
+
+
+def test_history_is_written_a_chunk_at_a_time(tmpdir):
+    filename = os.path.join(str(tmpdir), 'out', 'history.csv')
+    monitor = ConvergenceMonitor(MPI.COMM_SELF, filename, chunk_size=3)
+    for i in range(2):
+        monitor.update(i, i, 1., *make_fields([i], [0.], [0.], [0.]))
+    assert not os.path.exists(filename)
+
+    for i in range(2, 7):
+        monitor.update(i, i, 1., *make_fields([i], [0.], [0.], [0.]))
+    header, rows = read_rows(filename)
+    assert header == ConvergenceMonitor.columns
+    assert rows.shape == (6, len(ConvergenceMonitor.columns))
+
+    monitor.flush()
+    header, rows = read_rows(filename)
+    assert np.allclose(rows[:, 0], np.arange(7))
+    assert np.allclose(rows[:, 3], np.arange(7))
+
+
+def test_reset_starts_the_file_again(tmpdir):
+    filename = os.path.join(str(tmpdir), 'history.csv')
+    monitor = ConvergenceMonitor(MPI.COMM_SELF, filename, chunk_size=2)
+    for i in range(5):
+        monitor.update(i, i, 1., *make_fields([1.], [0.], [0.], [0.]))
+    monitor.flush()
+
+    monitor.reset()
+    monitor.update(10, 10, 1., *make_fields([1.], [0.], [0.], [0.]))
+    monitor.flush()
+    header, rows = read_rows(filename)
+    assert header == ConvergenceMonitor.columns
+    assert np.allclose(rows[:, 0], [10])
+
+
+def test_stages_share_the_file(tmpdir):
+    filename = os.path.join(str(tmpdir), 'history.csv')
+    stages = [ConvergenceMonitor(MPI.COMM_SELF, filename, chunk_size=2)
+              for stage in range(2)]
+    for stage, monitor in enumerate(stages):
+        monitor.reset(new_file=(stage == 0))
+        monitor.stage = stage
+        for i in range(3):
+            monitor.update(i, i, 1., *make_fields([1.], [0.], [0.], [0.]))
+        monitor.flush()
+    header, rows = read_rows(filename)
+    assert header == ConvergenceMonitor.columns
+    assert np.allclose(rows[:, 0], [0, 1, 2, 0, 1, 2])
+    assert np.allclose(rows[:, -1], [0, 0, 0, 1, 1, 1])
+
+
+def test_history_without_a_file(tmpdir):
+    monitor = ConvergenceMonitor(MPI.COMM_SELF, chunk_size=2)
+    for i in range(5):
+        monitor.update(i, i, 1., *make_fields([1.], [0.], [0.], [0.]))
+    monitor.flush()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_csv_history_writes_whole_chunks(tmpdir):
+    filename = os.path.join(str(tmpdir), 'table.csv')
+    history = CSVHistory(MPI.COMM_SELF, filename, ['a', 'b'], chunk_size=2)
+    for i in range(3):
+        history.append([i, 2*i])
+    header, rows = read_rows(filename)
+    assert header == ['a', 'b']
+    assert rows.shape == (2, 2)
+    history.flush()
+    header, rows = read_rows(filename)
+    assert np.allclose(rows[:, 1], [0, 2, 4])
+
+
+def make_monitor(residuals, criteria=None):
+    monitor = ConvergenceMonitor(MPI.COMM_SELF, criteria=criteria)
+    monitor.residuals = list(residuals)
+    monitor.residual_0 = residuals[0]
+    return monitor
+
+
+def test_tolerance_criterion():
+    criterion = ToleranceCriterion(1.0e-8, 1.0e-3)
+    assert criterion(make_monitor([1.0, 1.0e-2])) is None
+    assert criterion(make_monitor([1.0, 1.0e-4]))[0] == 'converged'
+    assert criterion(make_monitor([1.0e-7, 1.0e-9]))[0] == 'converged'
+
+
+def test_stagnation_criterion():
+    criterion = StagnationCriterion(3, 0.9)
+    assert criterion(make_monitor([1.0, 0.99, 0.98])) is None
+    assert criterion(make_monitor([1.0, 0.99, 0.98, 0.97]))[0] == 'abort'
+    assert criterion(make_monitor([1.0, 0.5, 0.4, 0.3])) is None
+
+
+def test_divergence_criterion():
+    criterion = DivergenceCriterion(1.0e6)
+    assert criterion(make_monitor([1.0, 10.0])) is None
+    assert criterion(make_monitor([1.0, 1.0e7]))[0] == 'abort'
+    assert criterion(make_monitor([1.0, np.nan]))[0] == 'abort'
+    assert criterion(make_monitor([1.0, np.inf]))[0] == 'abort'
+
+
+def test_check_returns_the_first_verdict():
+    criteria = [DivergenceCriterion(1.0e6), ToleranceCriterion(1.0, 1.0)]
+    monitor = make_monitor([1.0, np.nan], criteria)
+    assert monitor.check()[1] == 'Residual is not finite'
+    monitor = make_monitor([1.0, 0.5], criteria)
+    assert monitor.check()[0] == 'converged'
+    monitor = make_monitor([1.0, 0.5], criteria[:1])
+    assert monitor.check() is None
@@ -0,0 +1,99 @@
+"""
+.. test:: test_profiler
+   :synopsis: The stage timings and counters of the profiler
+
+"""
+
+import csv
+import json
+import os
+import time
+from mpi4py import MPI
+from peryton.helpers import Profiler, profile, profiler
+
+
+def make_profile():
+    p = Profiler()
+    with p.stage('assemble'):
+        time.sleep(0.01)
+    with p.stage('assemble'):
+        pass
+    p.count('ksp_iterations', 3)
+    p.end_iteration(0)
+    with p.stage('solve'):
+        pass
+    p.count('ksp_iterations', 2)
+    p.end_iteration(1)
+    return p
+
+
+def test_report():
+    report = make_profile().report(MPI.COMM_SELF)
+    assert report['n_processes'] == 1
+    assert list(report['stages'].keys()) == ['assemble', 'solve']
+
+    iterations = report['iterations']
+    assert [entry['iteration'] for entry in iterations] == [0, 1]
+    assert iterations[0]['ksp_iterations'] == 3
+    assert iterations[1]['ksp_iterations'] == 2
+    assert iterations[0]['assemble'] >= 0.01
+    assert iterations[1]['assemble'] == 0.
+
+    assemble = report['stages']['assemble']
+    assert abs(assemble['mean'] - iterations[0]['assemble']) < 1.0e-12
+    assert assemble['max'] == assemble['mean']
+    assert assemble['imbalance'] == 1.
+    assert report['peak_rss_mb']['mean'] > 0
+
+
+def test_nested_stages_are_not_counted_twice():
+    p = Profiler()
+    with p.stage('iteration'):
+        with p.stage('solve'):
+            time.sleep(0.02)
+            with p.stage('boundary_conditions'):
+                time.sleep(0.01)
+        with p.stage('solve'):
+            pass
+    p.end_iteration(0)
+    times = p.report(MPI.COMM_SELF)['iterations'][0]
+    assert times['boundary_conditions'] >= 0.01
+    assert 0.02 <= times['solve'] < 0.02 + times['boundary_conditions']
+    assert times['iteration'] < 0.01
+    total = times['iteration'] + times['solve'] + times['boundary_conditions']
+    assert total >= 0.03
+
+
+def test_report_files_an_unfinished_iteration():
+    p = Profiler()
+    p.count('ksp_iterations', 4)
+    report = p.report(MPI.COMM_SELF)
+    assert report['iterations'][0]['iteration'] is None
+    assert report['iterations'][0]['ksp_iterations'] == 4
+
+
+def test_write(tmpdir):
+    directory = os.path.join(str(tmpdir), 'out')
+    make_profile().write(directory, comm=MPI.COMM_SELF,
+                         metadata={'case': 'test'})
+    with open(os.path.join(directory, 'profile.json')) as f:
+        report = json.load(f)
+    assert report['metadata'] == {'case': 'test'}
+    with open(os.path.join(directory, 'profile.csv')) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['iteration', 'assemble', 'solve', 'ksp_iterations']
+    assert len(rows) == 3
+
+
+class Sampler(object):
+
+    @profile
+    def update(self):
+        return 1
+
+
+def test_profile_labels_methods_with_their_class():
+    profiler.reset()
+    assert Sampler().update() == 1
+    assert profiler.stage_names == ['Sampler.update']
+    assert Sampler.update.__name__ == 'update'
@@ -0,0 +1,60 @@
+"""
+.. test:: test_solver_options
+   :synopsis: Switching the solver presets between matrix types
+
+"""
+
+import pytest
+from peryton.solvers.velocity_pressure_solver import solver_presets, \
+                                                     set_mat_type
+
+
+def test_matfree_wraps_the_assembled_preconditioner():
+    params = set_mat_type(solver_presets['schur_lsc'], 'matfree')
+    assert params['mat_type'] == 'matfree'
+    assert params['pc_type'] == 'python'
+    assert params['pc_python_type'] == 'firedrake.AssembledPC'
+    assert params['assembled_pc_type'] == 'fieldsplit'
+    assert params['assembled_fieldsplit_1_pc_type'] == 'lsc'
+    assert params['ksp_type'] == solver_presets['schur_lsc']['ksp_type']
+    assert 'fieldsplit_1_pc_type' not in params
+
+
+def test_round_trip_restores_the_options():
+    for name in ['direct', 'schur_lsc', 'schur_gmg']:
+        params = set_mat_type(set_mat_type(solver_presets[name], 'matfree'),
+                              'aij')
+        assert params == solver_presets[name]
+
+
+def test_matfree_preset_unwraps_to_aij():
+    params = dict(solver_presets['schur_pcd'])
+    params['fieldsplit_1_pc_python_type'] = 'firedrake.MassInvPC'
+    params = set_mat_type(params, 'aij')
+    assert params['mat_type'] == 'aij'
+    assert params['fieldsplit_0_pc_type'] == 'gamg'
+    assert 'fieldsplit_0_pc_python_type' not in params
+    assert not any('assembled' in key for key in params)
+
+
+def test_presets_are_not_modified():
+    preset = dict(solver_presets['schur_lsc'])
+    set_mat_type(solver_presets['schur_lsc'], 'matfree')
+    assert solver_presets['schur_lsc'] == preset
+
+
+def test_nest_fieldsplit():
+    params = set_mat_type(solver_presets['schur_lsc'], 'nest')
+    assert params == dict(solver_presets['schur_lsc'], mat_type='nest')
+
+
+@pytest.mark.parametrize('name', ['schur_pcd', 'schur_pcd_p1'])
+@pytest.mark.parametrize('mat_type', ['aij', 'nest'])
+def test_matfree_preconditioners_need_matfree(name, mat_type):
+    with pytest.raises(ValueError):
+        set_mat_type(solver_presets[name], mat_type)
+
+
+def test_direct_nest_is_rejected():
+    with pytest.raises(ValueError):
+        set_mat_type(solver_presets['direct'], 'nest')